@@ -1,6 +1,11 @@
 from .PreProcessImage import PreProcessIm
 from .Prefetcher import Prefetcher
+from .ImageCache import ImageCache
+import os.path as osp
+from PIL import Image
 import numpy as np
+import multiprocessing
+import ctypes
 
 
 class Dataset(object):
@@ -8,6 +13,40 @@ class Dataset(object):
   Args:
     final_batch: bool. The last batch may not be complete, if to abandon this 
       batch, set 'final_batch' to False.
+    prefetch_backend: 'thread' or 'process', whether samples are prefetched
+      by threads or by worker processes.
+    preallocate_batch: bool. If True, `next_batch` writes images into a
+      float32 (or uint8, for unnormalized images) buffer that is reused across
+      batches and returns a view of it, so `torch.from_numpy(ims)` copies
+      nothing. The returned images are overwritten by the next call to
+      `next_batch`.
+    seed: (Optionally) an integer. If given, every sample draws its random
+      numbers from its own stream determined by (seed, epoch, index), the
+      shuffling of an epoch from one determined by (seed, epoch), and samples
+      are batched in index order, so that batches are reproducible with any
+      number of prefetching threads or processes. Workers then stay less than
+      the prefetch size (200 samples) ahead of the next sample to be batched,
+      so a slow sample holds back at most that many finished ones.
+    im_cache_bytes: if positive, decoded images (before cropping, mirroring
+      etc.) are kept in an LRU cache of this many bytes. With the 'process'
+      backend, each worker keeps its own cache, which lasts as long as the
+      worker, i.e. until `set_batch_size` or `stop_prefetching_threads`.
+    overlap_epochs: bool. If True, the next epoch is shuffled and prefetched
+      while the end of the current one is still being consumed. Only useful
+      for datasets iterated epoch after epoch, e.g. the training set.
+    collect_prefetch_stats: bool. If True, the prefetcher times sample
+      production and waiting on the queue, see `Prefetcher.stats`.
+    num_shards, shard_index: to split every epoch among several processes,
+      e.g. one per GPU or node. Each epoch order is cut into `num_shards`
+      disjoint shards of `dataset_size // num_shards` samples, and this
+      dataset only fetches shard `shard_index`; the remaining samples are left
+      out of the epoch. All shards must be created with the same `seed`, so
+      that they cut the same order.
+    draft_decode: bool. If True and images are resized, JPEG files are
+      decoded at a reduced resolution (1/2, 1/4 or 1/8, by the decoder's DCT
+      scaling) when they are at least twice as large as needed, see
+      `PreProcessIm.min_input_h_w`. Pixel values differ slightly from those of
+      resizing full resolution images.
   """
 
   def __init__(
@@ -17,35 +56,156 @@ class Dataset(object):
       final_batch=True,
       shuffle=True,
       num_prefetch_threads=1,
+      prefetch_backend='thread',
+      preallocate_batch=False,
+      im_cache_bytes=0,
+      seed=None,
+      overlap_epochs=False,
+      collect_prefetch_stats=False,
+      num_shards=1,
+      shard_index=0,
+      draft_decode=False,
       prng=np.random,
       **pre_process_im_kwargs):
 
+    assert 0 <= shard_index < num_shards
+    assert (num_shards == 1) or (seed is not None), \
+      'Shards have to share a `seed` to draw the same epoch orders'
+    self.num_shards = num_shards
+    self.shard_index = shard_index
+    self.shard_size = dataset_size // num_shards
+
     self.pre_process_im = PreProcessIm(
       prng=prng,
       **pre_process_im_kwargs)
 
     self.prefetcher = Prefetcher(
       self.get_sample,
-      dataset_size,
+      self.shard_size,
       batch_size,
       final_batch=final_batch,
-      num_threads=num_prefetch_threads)
+      num_threads=num_prefetch_threads,
+      backend=prefetch_backend,
+      worker_init=self.seed_worker,
+      ordered=seed is not None,
+      start_ep_func=self.start_epoch,
+      overlap_epochs=overlap_epochs,
+      collect_stats=collect_prefetch_stats)
 
+    self.dataset_size = dataset_size
     self.shuffle = shuffle
     self.epoch_done = True
     self.prng = prng
+    self.seed = seed
+    # The order of samples of `epoch` is row `epoch % 2`; only the latest two
+    # epochs are kept, since epochs overlap at most by one. In shared memory,
+    # so that prefetching processes see the orders drawn in the main process.
+    self.orders = np.frombuffer(
+      multiprocessing.RawArray(ctypes.c_int64, 2 * self.shard_size),
+      dtype=np.int64).reshape([2, self.shard_size])
+    self.preallocate_batch = preallocate_batch
+    self.batch_buffer = None
+    self.im_cache = ImageCache(im_cache_bytes) if im_cache_bytes > 0 else None
+    # (width, height) to pass to `PIL.Image.draft`, `None` to decode at full
+    # resolution.
+    self.draft_w_h = None
+    if draft_decode:
+      min_h_w = self.pre_process_im.min_input_h_w()
+      if min_h_w is not None:
+        self.draft_w_h = min_h_w[::-1]
 
   def set_mirror_type(self, mirror_type):
+    """With the 'process' backend, running workers keep the old mirror type;
+    `set_batch_size` restarts them."""
     self.pre_process_im.set_mirror_type(mirror_type)
 
-  def get_sample(self, ptr):
-    """Get one sample to put to queue."""
+  def seed_worker(self):
+    """Called in each prefetching process. Forked processes inherit the
+    random state of the main process, re-seed so that they do not all draw
+    the same crops, mirrors and images."""
+    np.random.seed()
+    self.prng.seed()
+
+  def epoch_prng(self, epoch):
+    """The random number generator for shuffling `epoch`, `None` if no `seed`
+    is given."""
+    if self.seed is None:
+      return None
+    return np.random.RandomState([self.seed, epoch])
+
+  def sample_prng(self, ptr, epoch):
+    """The random number generator for sample `ptr` of `epoch`, `None` if no
+    `seed` is given."""
+    if self.seed is None:
+      return None
+    # Keyed by the position in the whole epoch, so that shards do not share
+    # random numbers.
+    ptr += self.shard_index * self.shard_size
+    return np.random.RandomState([self.seed, epoch, ptr])
+
+  def start_epoch(self, epoch):
+    """Draw the order of samples of `epoch`. Called by the prefetcher before
+    any sample of `epoch` is fetched, possibly in a prefetching thread while
+    the previous epoch is still being consumed, overwriting the order of the
+    epoch before it."""
+    if self.shuffle:
+      prng = self.epoch_prng(epoch)
+      prng = self.prng if prng is None else prng
+      order = prng.permutation(self.dataset_size)
+    else:
+      order = np.arange(self.dataset_size)
+    start = self.shard_index * self.shard_size
+    self.orders[epoch % 2] = order[start:start + self.shard_size]
+
+  def sample_index(self, ptr, epoch):
+    """The index of sample `ptr` of `epoch` in the dataset."""
+    return self.orders[epoch % 2, ptr]
+
+  def read_im(self, im_name):
+    """Read an image as a uint8 numpy array with shape [H, W, 3], through
+    the image cache if there is one."""
+    if self.im_cache is not None:
+      return self.im_cache.get(im_name, self.load_im)
+    return self.load_im(im_name)
+
+  def load_im(self, im_name):
+    """Read an image from the image store if there is one, otherwise from
+    `im_dir`, at a reduced resolution if `draft_decode` is set."""
+    if self.im_store is not None:
+      return self.im_store[im_name]
+    im = Image.open(osp.join(self.im_dir, im_name))
+    if self.draft_w_h is not None:
+      # Only changes JPEG files, and only by factors that keep them at least
+      # as large as `draft_w_h`.
+      im.draft('RGB', self.draft_w_h)
+    return np.asarray(im)
+
+  def get_sample(self, ptr, epoch):
+    """Get sample `ptr` of `epoch` to put to queue."""
     raise NotImplementedError
 
   def next_batch(self):
     """Get a batch from the queue."""
     raise NotImplementedError
 
+  def stack_ims(self, ims):
+    """Transform a list of images into a numpy array with shape [N, ...]."""
+    if not self.preallocate_batch:
+      return np.stack(ims)
+    shape = ims[0].shape
+    # Unnormalized images are kept in their integer dtype.
+    dtype = np.float32 if ims[0].dtype.kind == 'f' else ims[0].dtype
+    if (self.batch_buffer is None) \
+        or (self.batch_buffer.shape[1:] != shape) \
+        or (self.batch_buffer.dtype != dtype) \
+        or (len(self.batch_buffer) < len(ims)):
+      self.batch_buffer = np.empty([len(ims)] + list(shape), dtype=dtype)
+    # The final batch may be smaller.
+    batch = self.batch_buffer[:len(ims)]
+    for i, im in enumerate(ims):
+      batch[i] = im
+    return batch
+
   def set_batch_size(self, batch_size):
     """You can change batch size, had better at the beginning of a new epoch.
     """
@@ -0,0 +1,78 @@
+import os
+import os.path as osp
+import shutil
+import hashlib
+import numpy as np
+
+from ..utils.utils import may_make_dir
+
+
+def file_md5(path, chunk_bytes=16 * 1024 ** 2):
+  """The md5 hex digest of the content of a file, e.g. a checkpoint."""
+  h = hashlib.md5()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(chunk_bytes), b''):
+      h.update(chunk)
+  return h.hexdigest()
+
+
+class FeatCache(object):
+  """Features of test sets on disk, so that evaluating the same model weights
+  again, e.g. with other re-ranking or distance settings, skips extraction.
+  Each entry is a directory named by a key, holding one `.npy` file per
+  feature, plus `ids.npy`, `cams.npy`, `im_names.npy` and `marks.npy`. An
+  entry is written under a temporary name and renamed when complete, so
+  readers never see a partial entry."""
+
+  META_NAMES = ('ids', 'cams', 'im_names', 'marks')
+
+  def __init__(self, cache_dir):
+    self.cache_dir = cache_dir
+
+  @staticmethod
+  def make_key(*parts):
+    """Hash `parts`, e.g. the md5 of the checkpoint, the images and the
+    pre-processing config, into a key. Parts are hashed by their `repr`, so
+    they should be strings, numbers, or (nested) tuples and sorted lists of
+    them."""
+    return hashlib.md5(repr(parts).encode('utf-8')).hexdigest()
+
+  def entry_dir(self, key):
+    return osp.join(self.cache_dir, key)
+
+  def load(self, key, feat_names):
+    """Returns `None` if the entry does not exist or misses some of
+    `feat_names`, otherwise the memory-mapped arrays
+      feats: a dict mapping each name in `feat_names` to its array
+      ids, cams, im_names, marks
+    """
+    entry_dir = self.entry_dir(key)
+    for name in tuple(feat_names) + self.META_NAMES:
+      if not osp.exists(osp.join(entry_dir, '{}.npy'.format(name))):
+        return None
+    load = lambda name: np.load(
+      osp.join(entry_dir, '{}.npy'.format(name)), mmap_mode='r')
+    feats = dict((name, load(name)) for name in feat_names)
+    return (feats,) + tuple(load(name) for name in self.META_NAMES)
+
+  def tmp_entry_dir(self, key):
+    """A fresh directory to write the entry of `key` into, before `commit`.
+    """
+    tmp_dir = '{}.{}.tmp'.format(self.entry_dir(key), os.getpid())
+    if osp.exists(tmp_dir):
+      shutil.rmtree(tmp_dir)
+    may_make_dir(tmp_dir)
+    return tmp_dir
+
+  def commit(self, key, tmp_dir, ids, cams, im_names, marks):
+    """Save the meta data next to the features in `tmp_dir`, and move it to
+    the entry of `key`. If another process has committed the entry first, it
+    is kept and `tmp_dir` is removed."""
+    for name, arr in zip(self.META_NAMES, (ids, cams, im_names, marks)):
+      np.save(osp.join(tmp_dir, '{}.npy'.format(name)), arr)
+    try:
+      os.rename(tmp_dir, self.entry_dir(key))
+    except OSError:
+      if not osp.isdir(self.entry_dir(key)):
+        raise
+      shutil.rmtree(tmp_dir)
@@ -0,0 +1,58 @@
+import threading
+from collections import OrderedDict
+
+
+class ImageCache(object):
+  """A thread safe LRU cache of decoded images, keyed by image name and
+  bounded by the total bytes of the cached numpy arrays."""
+
+  def __init__(self, max_bytes):
+    """
+    Args:
+      max_bytes: the byte budget; least recently used images are evicted
+        when it is exceeded
+    """
+    self.max_bytes = max_bytes
+    self.nbytes = 0
+    self.hits = 0
+    self.misses = 0
+    self._ims = OrderedDict()
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._ims)
+
+  def get(self, im_name, read_im):
+    """Return the cached image, or read it with `read_im(im_name)` and cache
+    it. The returned array is read-only."""
+    with self._lock:
+      im = self._ims.pop(im_name, None)
+      if im is not None:
+        # Re-insert to mark it as most recently used.
+        self._ims[im_name] = im
+        self.hits += 1
+        return im
+      self.misses += 1
+    # Decode outside the lock, so that threads can decode in parallel.
+    im = read_im(im_name)
+    im.flags.writeable = False
+    if im.nbytes > self.max_bytes:
+      return im
+    with self._lock:
+      if im_name not in self._ims:
+        self._ims[im_name] = im
+        self.nbytes += im.nbytes
+        while self.nbytes > self.max_bytes:
+          _, evicted = self._ims.popitem(last=False)
+          self.nbytes -= evicted.nbytes
+    return im
+
+  def clear(self):
+    with self._lock:
+      self._ims.clear()
+      self.nbytes = 0
+
+  def reset_counters(self):
+    with self._lock:
+      self.hits = 0
+      self.misses = 0
@@ -0,0 +1,93 @@
+from __future__ import print_function
+import sys
+import time
+import os.path as osp
+from PIL import Image
+import numpy as np
+import cv2
+
+from ..utils.utils import load_pickle
+from ..utils.utils import save_pickle
+from ..utils.utils import may_make_dir
+
+
+def get_im_store_file(partition_file, resize_h_w):
+  """The default location of the image store, next to the partition file."""
+  return osp.join(osp.dirname(partition_file),
+                  'images_{}x{}.npy'.format(*resize_h_w))
+
+
+def get_im_store_index_file(store_file):
+  return osp.splitext(store_file)[0] + '_index.pkl'
+
+
+def build_im_store(im_dir, partition_file, store_file, resize_h_w):
+  """Decode and resize all images listed in the partition file, and write them
+  into a single uint8 `.npy` file with shape [num_ims, H, W, 3]. A name to
+  offset index is saved alongside as a pickle file.
+  Args:
+    im_dir: the directory of the images
+    partition_file: the `partitions.pkl` of the dataset
+    store_file: path of the `.npy` file to write
+    resize_h_w: (height, width) of the stored images
+  """
+  partitions = load_pickle(partition_file)
+  im_names = set()
+  for key, val in partitions.items():
+    if key.endswith('_im_names'):
+      im_names.update(val)
+  im_names = sorted(im_names)
+
+  may_make_dir(osp.dirname(osp.abspath(store_file)))
+  ims = np.lib.format.open_memmap(
+    store_file, mode='w+', dtype=np.uint8,
+    shape=(len(im_names), resize_h_w[0], resize_h_w[1], 3))
+
+  printed = False
+  st = time.time()
+  for i, name in enumerate(im_names):
+    im = np.asarray(Image.open(osp.join(im_dir, name)))
+    if (im.shape[0], im.shape[1]) != tuple(resize_h_w):
+      im = cv2.resize(im, tuple(resize_h_w[::-1]),
+                      interpolation=cv2.INTER_LINEAR)
+    ims[i] = im
+
+    if (i + 1) % 1000 == 0 or i + 1 == len(im_names):
+      if not printed:
+        printed = True
+      else:
+        # Clean the current line
+        sys.stdout.write("\033[F\033[K")
+      print('{}/{} images packed, total {:.2f}s'
+            .format(i + 1, len(im_names), time.time() - st))
+  ims.flush()
+  del ims
+
+  index = dict(im_names=im_names, resize_h_w=tuple(resize_h_w))
+  save_pickle(index, get_im_store_index_file(store_file))
+
+
+class ImageStore(object):
+  """Read images packed by `build_im_store`. The file is memory mapped, so an
+  image is a zero-copy slice, served from the page cache once it has been
+  read."""
+
+  def __init__(self, store_file):
+    assert osp.exists(store_file), \
+      "Image store {} not found, build it with script/dataset/pack_images.py" \
+      .format(store_file)
+    self.ims = np.load(store_file, mmap_mode='r')
+    index = load_pickle(get_im_store_index_file(store_file))
+    self.resize_h_w = index['resize_h_w']
+    self.name_to_offset = dict(
+      zip(index['im_names'], range(len(index['im_names']))))
+
+  def __len__(self):
+    return len(self.name_to_offset)
+
+  def __contains__(self, im_name):
+    return im_name in self.name_to_offset
+
+  def __getitem__(self, im_name):
+    """Returns a read-only uint8 numpy array with shape [H, W, 3]."""
+    return self.ims[self.name_to_offset[im_name]]
@@ -0,0 +1,102 @@
+import os
+import os.path as osp
+import numpy as np
+
+from ..utils.utils import load_pickle
+from ..utils.utils import may_make_dir
+from ..utils.dataset_utils import parse_im_names
+
+
+def get_meta_index_dir(partition_file):
+  """The default location of the metadata index, next to the partition file."""
+  return osp.join(osp.dirname(partition_file), 'meta_index')
+
+
+def get_meta_index_file(index_dir, part, column):
+  return osp.join(index_dir, '{}_{}.npy'.format(part, column))
+
+
+def save_column(arr, path):
+  """Write to a temporary file and rename it, so that concurrent readers
+  never see a partial file."""
+  tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+  with open(tmp_path, 'wb') as f:
+    np.save(f, arr)
+  os.rename(tmp_path, path)
+
+
+def build_meta_index(partition_file, index_dir):
+  """Parse the partition file once into one `.npy` file per part and column:
+    {part}_im_names.npy: fixed-width image names
+    {part}_ids.npy: int32 person ids
+    {part}_cams.npy: int16 cameras
+    {part}_marks.npy: int8 marks, for parts that have them (val, test)
+    {part}_ids2labels.npy: int32 [id, label] pairs, for training parts
+  A `done` file is written last, and is newer than the partition file as long
+  as the index is up to date.
+  """
+  partitions = load_pickle(partition_file)
+  may_make_dir(index_dir)
+  for key in partitions:
+    if not key.endswith('_im_names'):
+      continue
+    part = key[:-len('_im_names')]
+    im_names = np.array(partitions[key], dtype=str)
+    save_column(im_names, get_meta_index_file(index_dir, part, 'im_names'))
+    save_column(parse_im_names(im_names, 'id').astype(np.int32),
+                get_meta_index_file(index_dir, part, 'ids'))
+    save_column(parse_im_names(im_names, 'cam').astype(np.int16),
+                get_meta_index_file(index_dir, part, 'cams'))
+    if '{}_marks'.format(part) in partitions:
+      save_column(np.array(partitions['{}_marks'.format(part)], dtype=np.int8),
+                  get_meta_index_file(index_dir, part, 'marks'))
+    if '{}_ids2labels'.format(part) in partitions:
+      ids2labels = partitions['{}_ids2labels'.format(part)]
+      save_column(np.array(sorted(ids2labels.items()), dtype=np.int32),
+                  get_meta_index_file(index_dir, part, 'ids2labels'))
+  with open(osp.join(index_dir, 'done'), 'w'):
+    pass
+
+
+def meta_index_is_fresh(partition_file, index_dir):
+  done_file = osp.join(index_dir, 'done')
+  return osp.exists(done_file) \
+         and osp.getmtime(done_file) >= osp.getmtime(partition_file)
+
+
+class MetaIndex(object):
+  """The columns of a dataset part, memory mapped from the files written by
+  `build_meta_index`. Columns a part does not have are `None`.
+  Attributes:
+    im_names: numpy array of fixed-width strings
+    ids, cams, marks: numpy arrays of int32, int16 and int8
+    ids2labels: a dict mapping ids to labels
+  """
+
+  def __init__(self, index_dir, part):
+    def load(column):
+      path = get_meta_index_file(index_dir, part, column)
+      return np.load(path, mmap_mode='r') if osp.exists(path) else None
+
+    self.im_names = load('im_names')
+    assert self.im_names is not None, \
+      "Part {} not found in {}".format(part, index_dir)
+    self.ids = load('ids')
+    self.cams = load('cams')
+    self.marks = load('marks')
+    ids2labels = load('ids2labels')
+    self.ids2labels = None
+    if ids2labels is not None:
+      self.ids2labels = dict(ids2labels.tolist())
+
+  def __len__(self):
+    return len(self.im_names)
+
+
+def load_meta_index(partition_file, part):
+  """Load the metadata index of a part, (re)building it first if it is missing
+  or older than the partition file."""
+  index_dir = get_meta_index_dir(partition_file)
+  if not meta_index_is_fresh(partition_file, index_dir):
+    build_meta_index(partition_file, index_dir)
+  return MetaIndex(index_dir, part)
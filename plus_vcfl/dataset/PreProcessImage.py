@@ -45,8 +45,8 @@ class PreProcessIm(object):
     self.batch_dims = batch_dims
     self.prng = prng
 
-  def __call__(self, im):
-    return self.pre_process_im(im)
+  def __call__(self, im, prng=None):
+    return self.pre_process_im(im, prng=prng)
 
   @staticmethod
   def check_mirror_type(mirror_type):
@@ -63,36 +63,116 @@ class PreProcessIm(object):
     self.mirror_type = mirror_type
 
   @staticmethod
-  def rand_crop_im(im, new_size, prng=np.random):
-    """Crop `im` to `new_size`: [new_w, new_h]."""
+  def rand_crop_im(im, new_size, prng=np.random, copy=True):
+    """Crop `im` to `new_size`: [new_w, new_h]. If `copy` is False, a view of
+    `im` is returned."""
     if (new_size[0] == im.shape[1]) and (new_size[1] == im.shape[0]):
       return im
     h_start = prng.randint(0, im.shape[0] - new_size[1])
     w_start = prng.randint(0, im.shape[1] - new_size[0])
-    im = np.copy(
-      im[h_start: h_start + new_size[1], w_start: w_start + new_size[0], :])
-    return im
+    im = im[h_start: h_start + new_size[1], w_start: w_start + new_size[0], :]
+    return np.copy(im) if copy else im
 
-  def pre_process_im(self, im):
-    """Pre-process image.
-    `im` is a numpy array with shape [H, W, 3], e.g. the result of
-    matplotlib.pyplot.imread(some_im_path), or
-    numpy.asarray(PIL.Image.open(some_im_path))."""
+  def min_input_h_w(self):
+    """The smallest (height, width) of an input image for which cropping and
+    resizing never upsample, `None` if there is no resizing. Images can be
+    decoded at a reduced resolution down to this size, see
+    `Dataset.load_im`."""
+    if self.resize_h_w is None:
+      return None
+    ratio = 1.
+    if (self.crop_ratio < 1) and (self.crop_prob > 0):
+      ratio = self.crop_ratio
+    return tuple(int(np.ceil(l / ratio)) for l in self.resize_h_w)
 
-    # Randomly crop a sub-image.
+  def crop_resize_im(self, im, prng=None):
+    """Randomly crop and resize `im` ([H, W, 3]), keeping its dtype. Draws
+    the same random numbers as the cropping in `pre_process_im`."""
+    prng = self.prng if prng is None else prng
     if ((self.crop_ratio < 1)
         and (self.crop_prob > 0)
-        and (self.prng.uniform() < self.crop_prob)):
-      h_ratio = self.prng.uniform(self.crop_ratio, 1)
-      w_ratio = self.prng.uniform(self.crop_ratio, 1)
+        and (prng.uniform() < self.crop_prob)):
+      h_ratio = prng.uniform(self.crop_ratio, 1)
+      w_ratio = prng.uniform(self.crop_ratio, 1)
       crop_h = int(im.shape[0] * h_ratio)
       crop_w = int(im.shape[1] * w_ratio)
-      im = self.rand_crop_im(im, (crop_w, crop_h), prng=self.prng)
+      # The crop is resized from a view of `im`, without copying it first.
+      im = self.rand_crop_im(im, (crop_w, crop_h), prng=prng,
+                             copy=self.resize_h_w is None)
 
-    # Resize.
     if (self.resize_h_w is not None) \
         and (self.resize_h_w != (im.shape[0], im.shape[1])):
       im = cv2.resize(im, self.resize_h_w[::-1], interpolation=cv2.INTER_LINEAR)
+    return im
+
+  def scale_and_shift(self):
+    """Fold scaling, mean subtraction and std division into `im * a + b`.
+    Returns:
+      a, b: float32 numpy arrays with shape [3]
+    """
+    a = np.ones([3], dtype=np.float64)
+    b = np.zeros([3], dtype=np.float64)
+    if self.scale:
+      a /= 255.
+    if self.im_mean is not None:
+      b -= np.array(self.im_mean)
+    if self.im_mean is not None and self.im_std is not None:
+      a /= np.array(self.im_std)
+      b /= np.array(self.im_std)
+    return a.astype(np.float32), b.astype(np.float32)
+
+  def pre_process_ims(self, ims, prng=None):
+    """Batch version of `pre_process_im`, computing in float32.
+    `ims` is a uint8 numpy array with shape [N, H, W, 3], or a list of [H, W, 3]
+    images that have the same size after resizing. Random numbers are drawn
+    in the same order as calling `pre_process_im` on each image in turn, from
+    `prng` if given, otherwise from `self.prng`.
+    If neither scaling nor mean subtraction is configured, e.g. when the model
+    normalizes its input, the images keep their dtype, so uint8 batches are
+    8 times smaller than float64 ones.
+    Returns:
+      ims: float32 (or input dtype) numpy array with shape [N, C, H, W] or
+        [N, H, W, C]
+      mirrored: bool numpy array with shape [N]
+    """
+    prng = self.prng if prng is None else prng
+    to_float = self.scale or (self.im_mean is not None)
+    ret = None
+    mirrored = np.zeros([len(ims)], dtype=bool)
+    for i, im in enumerate(ims):
+      im = self.crop_resize_im(im, prng=prng)
+      if self.mirror_type == 'always' \
+          or (self.mirror_type == 'random' and prng.uniform() > 0.5):
+        im = im[:, ::-1, :]
+        mirrored[i] = True
+      if self.batch_dims == 'NCHW':
+        im = im.transpose(2, 0, 1)
+      if ret is None:
+        # The only allocation for the batch.
+        ret = np.empty((len(ims),) + im.shape,
+                       dtype=np.float32 if to_float else im.dtype)
+      ret[i] = im
+
+    if not to_float:
+      return ret, mirrored
+    a, b = self.scale_and_shift()
+    if self.batch_dims == 'NCHW':
+      a = a[:, np.newaxis, np.newaxis]
+      b = b[:, np.newaxis, np.newaxis]
+    ret *= a
+    ret += b
+    return ret, mirrored
+
+  def pre_process_im(self, im, prng=None):
+    """Pre-process image.
+    `im` is a numpy array with shape [H, W, 3], e.g. the result of
+    matplotlib.pyplot.imread(some_im_path), or
+    numpy.asarray(PIL.Image.open(some_im_path)).
+    `prng` optionally replaces `self.prng` for this image."""
+    prng = self.prng if prng is None else prng
+
+    # Randomly crop a sub-image, and resize.
+    im = self.crop_resize_im(im, prng=prng)
 
     # scaled by 1/255.
     if self.scale:
@@ -110,7 +190,7 @@ class PreProcessIm(object):
     # May mirror image.
     mirrored = False
     if self.mirror_type == 'always' \
-        or (self.mirror_type == 'random' and self.prng.uniform() > 0.5):
+        or (self.mirror_type == 'random' and prng.uniform() > 0.5):
       im = im[:, ::-1, :]
       mirrored = True
 
@@ -1,61 +1,133 @@
 import threading
+import multiprocessing
+import ctypes
 import Queue
 import time
+from collections import deque
 
+import numpy as np
 
-class Counter(object):
-  """A thread safe counter."""
 
-  def __init__(self, val=0, max_val=0):
-    self._value = val
-    self.max_value = max_val
-    self._lock = threading.Lock()
+class PrefetchStats(object):
+  """Timings of a prefetcher, accumulated in shared memory, so that worker
+  processes as well as threads can add to them."""
+
+  # Offsets into `values`.
+  NUM_SAMPLES, SAMPLE_TIME, PUT_WAIT_TIME, NUM_GETS, GET_WAIT_TIME, \
+    QUEUE_DEPTH_SUM, QUEUE_DEPTH_MAX = range(7)
+
+  def __init__(self):
+    self.values = multiprocessing.Array('d', 7)
+    self.reset()
 
   def reset(self):
-    with self._lock:
-      self._value = 0
+    with self.values.get_lock():
+      self.values[:] = [0] * len(self.values)
+    self.start_time = time.time()
 
-  def set_max_value(self, max_val):
-    self.max_value = max_val
+  def add_sample(self, sample_time):
+    """Called by a worker after producing a sample."""
+    with self.values.get_lock():
+      self.values[self.NUM_SAMPLES] += 1
+      self.values[self.SAMPLE_TIME] += sample_time
+
+  def add_put_wait(self, wait_time):
+    """Called by a worker that waited for room in the queue."""
+    with self.values.get_lock():
+      self.values[self.PUT_WAIT_TIME] += wait_time
+
+  def add_get(self, wait_time, queue_depth):
+    """Called by the consumer after getting a sample, with the queue depth
+    seen before getting it."""
+    with self.values.get_lock():
+      self.values[self.NUM_GETS] += 1
+      self.values[self.GET_WAIT_TIME] += wait_time
+      self.values[self.QUEUE_DEPTH_SUM] += queue_depth
+      self.values[self.QUEUE_DEPTH_MAX] = max(
+        self.values[self.QUEUE_DEPTH_MAX], queue_depth)
+
+  def summary(self):
+    """Returns a dict of
+      elapsed: seconds since the last reset
+      num_samples: number of samples produced by workers
+      sample_time: mean seconds to produce (read, decode and pre-process)
+        a sample, in a worker
+      worker_wait_time: total seconds workers waited on a full queue
+      consumer_wait_time: total seconds the consumer waited on an empty queue
+      consumer_wait_ratio: `consumer_wait_time` over `elapsed`, i.e. how much
+        of the time the training loop was starved of data
+      queue_depth_mean, queue_depth_max: the queue depth seen by the consumer
+    """
+    with self.values.get_lock():
+      v = list(self.values)
+    elapsed = time.time() - self.start_time
+    return dict(
+      elapsed=elapsed,
+      num_samples=int(v[self.NUM_SAMPLES]),
+      sample_time=v[self.SAMPLE_TIME] / max(v[self.NUM_SAMPLES], 1),
+      worker_wait_time=v[self.PUT_WAIT_TIME],
+      consumer_wait_time=v[self.GET_WAIT_TIME],
+      consumer_wait_ratio=v[self.GET_WAIT_TIME] / max(elapsed, 1e-6),
+      queue_depth_mean=v[self.QUEUE_DEPTH_SUM] / max(v[self.NUM_GETS], 1),
+      queue_depth_max=v[self.QUEUE_DEPTH_MAX])
 
-  def increment(self):
-    with self._lock:
-      if self._value < self.max_value:
-        self._value += 1
-        incremented = True
-      else:
-        incremented = False
-      return incremented, self._value
 
-  def get_value(self):
-    with self._lock:
-      return self._value
+def elements_ahead(epoch, ptr, consumer_epoch, consumer_ptr, num_elements):
+  """How far element `ptr` of `epoch` is ahead of the consumer's position,
+  counting all elements of an epoch before those of the next."""
+  return (epoch - consumer_epoch) * num_elements + ptr - consumer_ptr
 
 
 class Enqueuer(object):
-  def __init__(self, get_element, num_elements, num_threads=1, queue_size=20):
+  def __init__(self, get_element, num_elements, num_threads=1, queue_size=20,
+               start_ep_func=None, stats=None, max_ahead=0):
     """
     Args:
-      get_element: a function that takes a pointer and returns an element
+      get_element: a function that takes a pointer and an epoch and returns an
+        element
       num_elements: total number of elements to put into the queue
       num_threads: num of parallel threads, >= 1
       queue_size: the maximum size of the queue. Set to some positive integer
         to save memory, otherwise, set to 0.
+      start_ep_func: (Optionally) a function that takes an epoch and is called
+        before any element of that epoch is produced
+      stats: (Optionally) a `PrefetchStats` that threads add timings to
+      max_ahead: if positive, an element is only claimed while it is less
+        than this many elements ahead of the consumer's position, see
+        `advance`. Otherwise, only `queue_size` bounds how far threads run
+        ahead.
+
+    All states below are guarded by one condition variable, which threads and
+    the caller wait on instead of polling. A thread is either idle (waiting
+    for an epoch), busy (producing and putting a claimed element), or exited.
+    Resetting bumps `generation`, so that elements claimed before the reset
+    are dropped instead of enqueued, and waits until no thread is busy.
+    Epochs are numbered from 1. When the elements of `epoch` run out, threads
+    start the next epoch by themselves, as long as it is not after
+    `last_epoch`.
     """
     self.get_element = get_element
     assert num_threads > 0
     self.num_threads = num_threads
     self.queue_size = queue_size
-    self.queue = Queue.Queue(maxsize=queue_size)
+    self.start_ep_func = start_ep_func
+    self.stats = stats
+    self.queue = deque()
+    self.cond = threading.Condition()
     # The pointer shared by threads.
-    self.ptr = Counter(max_val=num_elements)
-    # The event to wake up threads, it's set at the beginning of an epoch.
-    # It's cleared after an epoch is enqueued or when the states are reset.
-    self.event = threading.Event()
-    # To reset states.
-    self.reset_event = threading.Event()
-    # The event to terminate the threads.
-    self.stop_event = threading.Event()
+    self.ptr = 0
+    self.num_elements = num_elements
+    self.epoch = 0
+    self.last_epoch = 0
+    # Whether elements of `epoch` are left to be claimed.
+    self.running = False
+    self.generation = 0
+    self.num_busy = 0
+    self.stopped = False
+    self.max_ahead = max_ahead
+    # The (epoch, ptr) of the next element the consumer fetches.
+    self.consumer_epoch = 0
+    self.consumer_ptr = 0
     self.threads = []
     for _ in range(num_threads):
       thread = threading.Thread(target=self.enqueue)
@@ -64,77 +136,548 @@ class Enqueuer(object):
       thread.start()
       self.threads.append(thread)
 
-  def start_ep(self):
-    """Start enqueuing an epoch."""
-    self.event.set()
+  def start_ep(self, epoch, last_epoch=None):
+    """Start enqueuing `epoch`, unless it has been started ahead of time, and
+    allow the epochs after it up to `last_epoch` to be started as soon as all
+    elements of the previous one have been claimed."""
+    with self.cond:
+      if self.epoch < epoch:
+        self._begin_ep(epoch)
+      self.last_epoch = epoch if last_epoch is None else last_epoch
+      self.consumer_epoch, self.consumer_ptr = epoch, 0
+      self.cond.notify_all()
+
+  def advance(self, epoch, ptr):
+    """Tell threads that the consumer has fetched all elements of `epoch`
+    before `ptr`. Only needed with `max_ahead`."""
+    with self.cond:
+      self.consumer_epoch, self.consumer_ptr = epoch, ptr
+      self.cond.notify_all()
+
+  def _within_reach(self):
+    """Only call it with `cond` held."""
+    return (self.max_ahead <= 0) or elements_ahead(
+      self.epoch, self.ptr, self.consumer_epoch, self.consumer_ptr,
+      self.num_elements) < self.max_ahead
+
+  def _begin_ep(self, epoch):
+    """Only call it with `cond` held."""
+    if self.start_ep_func is not None:
+      self.start_ep_func(epoch)
+    self.epoch = epoch
+    self.ptr = 0
+    self.running = self.num_elements > 0
 
   def end_ep(self):
-    """When all elements are enqueued, let threads sleep to save resources."""
-    self.event.clear()
-    self.ptr.reset()
+    """Stop handing out elements of the current epoch."""
+    with self.cond:
+      self.running = False
 
   def reset(self):
-    """Reset the threads, pointer and the queue to initial states. In common
-    case, this will not be called."""
-    self.reset_event.set()
-    self.event.clear()
-    # wait for threads to pause. This is not an absolutely safe way. The safer
-    # way is to check some flag inside a thread, not implemented yet.
-    time.sleep(5)
-    self.reset_event.clear()
-    self.ptr.reset()
-    self.queue = Queue.Queue(maxsize=self.queue_size)
+    """Reset the threads, pointer and the queue to initial states. Returns
+    when no thread is working on an element claimed before the reset."""
+    with self.cond:
+      self.generation += 1
+      self.running = False
+      self.ptr = 0
+      self.epoch = 0
+      self.last_epoch = 0
+      self.consumer_epoch = 0
+      self.consumer_ptr = 0
+      self.queue.clear()
+      self.cond.notify_all()
+      while self.num_busy > 0:
+        self.cond.wait()
 
   def set_num_elements(self, num_elements):
     """Reset the max number of elements."""
-    self.reset()
-    self.ptr.set_max_value(num_elements)
+    with self.cond:
+      self.reset()
+      self.num_elements = num_elements
 
   def stop(self):
     """Wait for threads to terminate."""
-    self.stop_event.set()
+    with self.cond:
+      self.stopped = True
+      self.cond.notify_all()
     for thread in self.threads:
       thread.join()
 
+  def get(self):
+    """Wait for the next element.
+    Returns:
+      (epoch, ptr, element)
+    """
+    with self.cond:
+      while len(self.queue) == 0:
+        self.cond.wait()
+      element = self.queue.popleft()
+      self.cond.notify_all()
+      return element
+
+  def qsize(self):
+    with self.cond:
+      return len(self.queue)
+
+  def _claim(self):
+    """Returns (epoch, ptr, generation) of a claimed element, or `None` to
+    exit."""
+    with self.cond:
+      while not self.stopped:
+        if not self.running and self.epoch < self.last_epoch:
+          self._begin_ep(self.epoch + 1)
+        elif self.running and self._within_reach():
+          break
+        else:
+          self.cond.wait()
+      if self.stopped:
+        return None
+      ptr = self.ptr
+      self.ptr += 1
+      if self.ptr >= self.num_elements:
+        self.running = False
+      self.num_busy += 1
+      return self.epoch, ptr, self.generation
+
+  def _put(self, epoch, ptr, element, generation):
+    with self.cond:
+      wait_st = None
+      while (not self.stopped) and (generation == self.generation) \
+          and (0 < self.queue_size <= len(self.queue)):
+        if (wait_st is None) and (self.stats is not None):
+          wait_st = time.time()
+        self.cond.wait()
+      if wait_st is not None:
+        self.stats.add_put_wait(time.time() - wait_st)
+      if (not self.stopped) and (generation == self.generation):
+        self.queue.append((epoch, ptr, element))
+      self.num_busy -= 1
+      self.cond.notify_all()
+
   def enqueue(self):
-    while not self.stop_event.isSet():
-      # If the enqueuing event is not set, the thread just waits.
-      if not self.event.wait(0.5): continue
-      # Increment the counter to claim that this element has been enqueued by
-      # this thread.
-      incremented, ptr = self.ptr.increment()
-      if incremented:
-        element = self.get_element(ptr - 1)
-        # When enqueuing, keep an eye on the stop and reset signal.
-        while not self.stop_event.isSet() and not self.reset_event.isSet():
-          try:
-            # This operation will wait at most `timeout` for a free slot in
-            # the queue to be available.
-            self.queue.put(element, timeout=0.5)
-            break
-          except:
-            pass
-      else:
-        self.end_ep()
+    while True:
+      claimed = self._claim()
+      if claimed is None:
+        break
+      epoch, ptr, generation = claimed
+      try:
+        if self.stats is not None:
+          st = time.time()
+        element = self.get_element(ptr, epoch)
+        if self.stats is not None:
+          self.stats.add_sample(time.time() - st)
+      except:
+        # Do not leave `reset` waiting for this thread.
+        with self.cond:
+          self.num_busy -= 1
+          self.cond.notify_all()
+        raise
+      self._put(epoch, ptr, element, generation)
     print('Exiting thread {}!!!!!!!!'.format(threading.current_thread().name))
 
 
+class _SlotArray(object):
+  """Placeholder left in a sample for an array that was written to a slot."""
+
+  def __init__(self, offset, shape, dtype):
+    self.offset = offset
+    self.shape = shape
+    self.dtype = dtype
+
+
+class SharedMemoryRing(object):
+  """A fixed number of fixed-size slots in shared memory, used as a queue
+  between worker processes and the main process. Workers write the numpy
+  arrays of a sample straight into a free slot and only send the slot index
+  and the small remaining python objects through a `multiprocessing.Queue`,
+  so image arrays are never pickled."""
+
+  # Arrays are placed in a slot at offsets that are multiples of this.
+  alignment = 16
+
+  def __init__(self, num_slots, slot_nbytes):
+    """
+    Args:
+      num_slots: number of slots, i.e. the maximum number of samples held
+      slot_nbytes: size of each slot in bytes. Arrays of a sample that do not
+        fit are pickled through the queue as usual.
+    """
+    self.num_slots = num_slots
+    self.slot_nbytes = self.aligned(slot_nbytes)
+    self.buffer = multiprocessing.RawArray(
+      ctypes.c_uint8, num_slots * self.slot_nbytes)
+    self.slots = np.frombuffer(self.buffer, dtype=np.uint8).reshape(
+      [num_slots, self.slot_nbytes])
+    self.reset()
+
+  @classmethod
+  def aligned(cls, nbytes):
+    return (nbytes + cls.alignment - 1) // cls.alignment * cls.alignment
+
+  @classmethod
+  def element_nbytes(cls, element):
+    """Slot space needed by the arrays in `element`."""
+    if isinstance(element, np.ndarray) and element.dtype != object:
+      return cls.aligned(element.nbytes)
+    if isinstance(element, (list, tuple)):
+      return sum(cls.element_nbytes(e) for e in element)
+    return 0
+
+  def reset(self):
+    """Mark all slots free. Only call it when no worker is running."""
+    # Counts the free slots. Free slots are found through `busy` under `lock`,
+    # rather than passed through a queue, so that the main process never
+    # writes to a pipe.
+    self.num_free = multiprocessing.Semaphore(self.num_slots)
+    self.lock = multiprocessing.Lock()
+    self.busy = np.frombuffer(
+      multiprocessing.RawArray(ctypes.c_uint8, self.num_slots), dtype=np.uint8)
+    self.cancelled = multiprocessing.Event()
+    self.filled_slots = multiprocessing.Queue()
+
+  def _pack(self, obj, slot, offset):
+    if isinstance(obj, np.ndarray) and obj.dtype != object:
+      nbytes = self.aligned(obj.nbytes)
+      if offset + nbytes > self.slot_nbytes:
+        return obj, offset
+      dst = slot[offset:offset + obj.nbytes].view(obj.dtype)
+      dst = dst.reshape(obj.shape)
+      # Also makes flipped or transposed views contiguous.
+      dst[...] = obj
+      return _SlotArray(offset, obj.shape, obj.dtype), offset + nbytes
+    if isinstance(obj, (list, tuple)):
+      packed = []
+      for o in obj:
+        o, offset = self._pack(o, slot, offset)
+        packed.append(o)
+      return type(obj)(packed), offset
+    return obj, offset
+
+  def _unpack(self, obj, slot):
+    if isinstance(obj, _SlotArray):
+      nbytes = int(np.prod(obj.shape)) * obj.dtype.itemsize
+      src = slot[obj.offset:obj.offset + nbytes].view(obj.dtype)
+      return src.reshape(obj.shape).copy()
+    if isinstance(obj, (list, tuple)):
+      return type(obj)([self._unpack(o, slot) for o in obj])
+    return obj
+
+  def put(self, element, stats=None):
+    """Called in a worker process. Wait for a free slot, and add the waiting
+    time to `stats` if given.
+    Returns:
+      whether the element was put, `False` if the wait was cancelled by
+      `cancel_waiting`
+    """
+    if stats is None:
+      self.num_free.acquire()
+    elif not self.num_free.acquire(False):
+      wait_st = time.time()
+      self.num_free.acquire()
+      stats.add_put_wait(time.time() - wait_st)
+    if self.cancelled.is_set():
+      return False
+    with self.lock:
+      i = int(np.flatnonzero(self.busy == 0)[0])
+      self.busy[i] = 1
+    packed, _ = self._pack(element, self.slots[i], 0)
+    self.filled_slots.put((i, packed))
+    return True
+
+  def cancel_waiting(self, num_workers):
+    """Wake up workers waiting for a free slot and make them give up. Call
+    `reset` after they exit."""
+    self.cancelled.set()
+    for _ in range(num_workers):
+      self.num_free.release()
+
+  def get(self):
+    """Called in the main process. Wait for a sample and free its slot."""
+    i, packed = self.filled_slots.get()
+    element = self._unpack(packed, self.slots[i])
+    with self.lock:
+      self.busy[i] = 0
+    self.num_free.release()
+    return element
+
+  def drop_filled(self):
+    """Discard the samples that have arrived, without freeing their slots."""
+    try:
+      while True:
+        self.filled_slots.get_nowait()
+    except Queue.Empty:
+      pass
+
+  def qsize(self):
+    return self.filled_slots.qsize()
+
+
+class ProcessEnqueuer(object):
+  def __init__(self, get_element, num_elements, num_threads=1, queue_size=20,
+               start_ep_func=None, stats=None, worker_init=None,
+               slot_nbytes=None, max_ahead=0):
+    """Same interface as `Enqueuer`, but elements are produced in worker
+    processes, so that decoding and pre-processing are not serialized by the
+    GIL. Workers are forked in the first `start_ep` and live until `reset`,
+    waiting for the shared epoch counter to reach an epoch they may claim
+    elements from. Thus they see the state of the dataset (e.g. mirror type,
+    image cache) as of that time, apart from what `start_ep_func`, which is
+    called in the main process, keeps in shared memory (e.g. epoch orders).
+    Args:
+      get_element: a function that takes a pointer and an epoch and returns an
+        element
+      num_elements: total number of elements to put into the queue
+      num_threads: num of parallel processes, >= 1
+      queue_size: number of shared memory slots; non-positive values mean
+        two slots per process
+      start_ep_func: (Optionally) a function that takes an epoch and is called
+        in the main process before any element of that epoch is produced
+      stats: (Optionally) a `PrefetchStats` that workers add timings to
+      worker_init: (Optionally) a function called at the start of each worker
+        process, e.g. to re-seed random number generators
+      slot_nbytes: size of each slot in bytes. If `None`, it is measured on
+        the first element, which is produced in a child process forked before
+        the workers and passed back by pickling.
+      max_ahead: see `Enqueuer`
+    """
+    self.get_element = get_element
+    assert num_threads > 0
+    self.num_threads = num_threads
+    self.queue_size = queue_size if queue_size > 0 else 2 * num_threads
+    self.num_elements = num_elements
+    self.start_ep_func = start_ep_func
+    self.stats = stats
+    self.worker_init = worker_init
+    self.slot_nbytes = slot_nbytes
+    self.max_ahead = max_ahead
+    self.new_pointer()
+    # The last epoch `start_ep_func` has been called for.
+    self.started_epoch = 0
+    # The event to terminate the processes.
+    self.stop_event = multiprocessing.Event()
+    # The ring is created lazily, so that elements can be produced when the
+    # dataset is fully constructed.
+    self.queue = None
+    # The element produced to measure `slot_nbytes`, returned by the first
+    # `get`.
+    self.first_element = None
+    self.processes = []
+
+  def new_pointer(self):
+    """The (epoch, pointer) shared by processes, the last epoch they may
+    claim elements from, and the (epoch, pointer) of the consumer, guarded by
+    the lock of `ptr`. Workers wait on `progress` for any of them to change.
+    """
+    self.ptr = multiprocessing.Value('l', 0)
+    self.epoch = multiprocessing.Value('l', 0, lock=False)
+    self.last_epoch = multiprocessing.Value('l', 0, lock=False)
+    self.consumer = multiprocessing.Array('l', 2, lock=False)
+    self.progress = multiprocessing.Condition(self.ptr.get_lock())
+
+  def start_ep(self, epoch, last_epoch=None):
+    """Start enqueuing `epoch`, unless it has been started ahead of time, and
+    allow the epochs after it up to `last_epoch` to be started as soon as all
+    elements of the previous one have been claimed."""
+    last_epoch = epoch if last_epoch is None else last_epoch
+    if self.started_epoch < epoch:
+      # Workers have claimed all elements up to `started_epoch`, and wait
+      # until `last_epoch` is raised below.
+      with self.progress:
+        self.epoch.value = epoch
+        self.ptr.value = 0
+    if self.start_ep_func is not None:
+      for ep in range(max(self.started_epoch + 1, epoch), last_epoch + 1):
+        self.start_ep_func(ep)
+    self.started_epoch = max(self.started_epoch, last_epoch)
+    if self.queue is None:
+      self.start_processes(epoch)
+    with self.progress:
+      self.last_epoch.value = last_epoch
+      self.consumer[:] = [epoch, 0]
+      self.progress.notify_all()
+
+  def start_processes(self, epoch):
+    """Create the ring and fork the workers. Only call it before any element
+    of `epoch` has been claimed."""
+    if (self.slot_nbytes is None) and (self.num_elements > 0):
+      self.first_element = (epoch, 0, self.produce_in_child(0, epoch))
+      self.slot_nbytes = SharedMemoryRing.element_nbytes(self.first_element[2])
+      with self.progress:
+        self.ptr.value = 1
+    self.queue = SharedMemoryRing(self.queue_size, self.slot_nbytes or 0)
+    self.stop_event.clear()
+    for _ in range(self.num_threads):
+      process = multiprocessing.Process(target=self.enqueue)
+      # Set the process in daemon mode, so that the main program ends normally.
+      process.daemon = True
+      process.start()
+      self.processes.append(process)
+
+  def produce_in_child(self, ptr, epoch):
+    """Produce element `ptr` of `epoch` in a child process, so that the main
+    process does not spend time decoding, nor touch the random state of the
+    workers to be forked."""
+    result = multiprocessing.Queue()
+
+    def produce():
+      element = None
+      try:
+        if self.worker_init is not None:
+          self.worker_init()
+        if self.stats is not None:
+          st = time.time()
+        element = self.get_element(ptr, epoch)
+        if self.stats is not None:
+          self.stats.add_sample(time.time() - st)
+      finally:
+        # Do not leave the main process waiting if it failed.
+        result.put(element)
+
+    process = multiprocessing.Process(target=produce)
+    process.daemon = True
+    process.start()
+    element = result.get()
+    process.join()
+    assert element is not None, \
+      'Failed to produce element {} of epoch {}'.format(ptr, epoch)
+    return element
+
+  def end_ep(self):
+    """Workers wait for the next epoch by themselves."""
+    pass
+
+  def advance(self, epoch, ptr):
+    """See `Enqueuer.advance`."""
+    with self.progress:
+      self.consumer[:] = [epoch, ptr]
+      self.progress.notify_all()
+
+  def join_processes(self, timeout=None):
+    for process in self.processes:
+      process.join(timeout)
+      if process.is_alive():
+        process.terminate()
+        process.join()
+    self.processes = []
+
+  def reset(self):
+    """Terminate the workers and reset the pointer and the queue to initial
+    states. Workers are forked again by the next `start_ep`."""
+    self.stop_event.set()
+    with self.progress:
+      self.progress.notify_all()
+    if self.queue is not None:
+      self.queue.cancel_waiting(len(self.processes))
+    # Workers exit after at most the element at hand. Meanwhile, keep reading
+    # what they put, so that none blocks on flushing to a full pipe.
+    # Terminating is only a fallback for a worker that hangs.
+    deadline = time.time() + 5
+    for process in self.processes:
+      while process.is_alive() and time.time() < deadline:
+        if self.queue is not None:
+          self.queue.drop_filled()
+        process.join(0.01)
+    self.join_processes(timeout=0)
+    # A terminated worker may have died holding the lock of the pointer.
+    self.new_pointer()
+    self.started_epoch = 0
+    self.first_element = None
+    # The ring is created again with the workers.
+    self.queue = None
+
+  def set_num_elements(self, num_elements):
+    """Reset the max number of elements."""
+    self.reset()
+    self.num_elements = num_elements
+
+  def stop(self):
+    """Wait for processes to terminate."""
+    self.reset()
+
+  def get(self):
+    """Wait for the next element.
+    Returns:
+      (epoch, ptr, element)
+    """
+    if self.first_element is not None:
+      element, self.first_element = self.first_element, None
+      return element
+    return self.queue.get()
+
+  def qsize(self):
+    if self.queue is None:
+      return 0
+    return self.queue.qsize() + int(self.first_element is not None)
+
+  def enqueue(self):
+    if self.worker_init is not None:
+      self.worker_init()
+    while True:
+      # Claim an element, moving on to the next epoch if allowed, or wait.
+      with self.progress:
+        while True:
+          if self.stop_event.is_set():
+            return
+          while (self.ptr.value >= self.num_elements) \
+              and (self.epoch.value < self.last_epoch.value):
+            self.epoch.value += 1
+            self.ptr.value = 0
+          epoch, ptr = self.epoch.value, self.ptr.value
+          if (ptr < self.num_elements) and (epoch <= self.last_epoch.value) \
+              and ((self.max_ahead <= 0) or elements_ahead(
+                epoch, ptr, self.consumer[0], self.consumer[1],
+                self.num_elements) < self.max_ahead):
+            break
+          self.progress.wait()
+        self.ptr.value += 1
+      if self.stats is not None:
+        st = time.time()
+      element = self.get_element(ptr, epoch)
+      if self.stats is not None:
+        self.stats.add_sample(time.time() - st)
+      if not self.queue.put((epoch, ptr, element), stats=self.stats):
+        return
+
+
 class Prefetcher(object):
   """This helper class enables sample enqueuing and batch dequeuing, to speed
   up batch fetching. It abstracts away the enqueuing and dequeuing logic."""
 
   def __init__(self, get_sample, dataset_size, batch_size, final_batch=True,
-               num_threads=1, prefetch_size=200):
+               num_threads=1, prefetch_size=200, backend='thread',
+               worker_init=None, ordered=False, start_ep_func=None,
+               overlap_epochs=False, collect_stats=False):
     """
     Args:
-      get_sample: a function that takes a pointer (index) and returns a sample
+      get_sample: a function that takes a pointer (index) and an epoch, and
+        returns a sample
       dataset_size: total number of samples in the dataset
       final_batch: True or False, whether to keep or drop the final incomplete
         batch
-      num_threads: num of parallel threads, >= 1
+      num_threads: num of parallel threads (or processes), >= 1
       prefetch_size: the maximum size of the queue. Set to some positive integer
         to save memory, otherwise, set to 0.
+      backend: 'thread' or 'process'. With 'process', samples are produced in
+        worker processes and passed back through shared memory.
+      worker_init: (Optionally) a function called at the start of each worker
+        process; only used by the 'process' backend
+      ordered: whether samples come out in the order of their pointers. Then a
+        batch does not depend on the number of threads or their scheduling.
+        Workers only claim samples less than `prefetch_size` ahead of the one
+        being fetched, so that at most that many are held out of order.
+      start_ep_func: (Optionally) a function that takes an epoch (numbered
+        from 1) and is called before any sample of that epoch is fetched,
+        e.g. to draw its order
+      overlap_epochs: whether to start prefetching the next epoch (calling
+        `start_ep_func` for it) as soon as all samples of the current one have
+        been claimed, instead of when the current one has been consumed. Then
+        the queue does not run dry at epoch boundaries. Samples of different
+        epochs are still never mixed in a batch.
+      collect_stats: whether to time the workers and the consumer, see
+        `stats`. When False, nothing is timed.
     """
+    assert backend in ['thread', 'process']
+    self.prefetch_stats = PrefetchStats() if collect_stats else None
     self.full_dataset_size = dataset_size
     self.final_batch = final_batch
     final_sz = self.full_dataset_size % batch_size
@@ -142,21 +685,45 @@ class Prefetcher(object):
       dataset_size = self.full_dataset_size - final_sz
     self.dataset_size = dataset_size
     self.batch_size = batch_size
-    self.enqueuer = Enqueuer(get_element=get_sample, num_elements=dataset_size,
-                             num_threads=num_threads, queue_size=prefetch_size)
+    if backend == 'process':
+      self.enqueuer = ProcessEnqueuer(
+        get_element=get_sample, num_elements=dataset_size,
+        num_threads=num_threads, queue_size=prefetch_size,
+        start_ep_func=start_ep_func, stats=self.prefetch_stats,
+        worker_init=worker_init, max_ahead=prefetch_size if ordered else 0)
+    else:
+      self.enqueuer = Enqueuer(
+        get_element=get_sample, num_elements=dataset_size,
+        num_threads=num_threads, queue_size=prefetch_size,
+        start_ep_func=start_ep_func, stats=self.prefetch_stats,
+        max_ahead=prefetch_size if ordered else 0)
     # The pointer indicating whether an epoch has been fetched from the queue
     self.ptr = 0
     self.ep_done = True
+    # The epoch being fetched from the queue.
+    self.ep = 0
+    self.ordered = ordered
+    self.overlap_epochs = overlap_epochs
+    # Maps epoch to {ptr: sample}, samples that arrived ahead of being
+    # fetched, i.e. ahead of `self.ptr` when `ordered`, or of a later epoch.
+    self.pending = {}
 
   def set_batch_size(self, batch_size):
     """You had better change batch size at the beginning of a new epoch."""
     final_sz = self.full_dataset_size % batch_size
+    self.dataset_size = self.full_dataset_size
     if not self.final_batch:
-      self.dataset_size = self.full_dataset_size - final_sz
+      self.dataset_size -= final_sz
     self.enqueuer.set_num_elements(self.dataset_size)
+    self.pending = {}
     self.batch_size = batch_size
     self.ep_done = True
 
+  def set_dataset_size(self, dataset_size):
+    """You had better change dataset size at the beginning of a new epoch."""
+    self.full_dataset_size = dataset_size
+    self.set_batch_size(self.batch_size)
+
   def next_batch(self):
     """Return a batch of samples, meanwhile indicate whether the epoch is
     done. The purpose of this func is mainly to abstract away the loop and the
@@ -177,9 +744,10 @@ class Prefetcher(object):
         self.ep_done = True
         break
       else:
+        sample = self.next_sample()
         self.ptr += 1
-        sample = self.enqueuer.queue.get()
-        # print('queue size {}'.format(self.enqueuer.queue.qsize()))
+        if self.ordered:
+          self.enqueuer.advance(self.ep, self.ptr)
         samples.append(sample)
     # print 'queue size: {}'.format(self.enqueuer.queue.qsize())
     # Indeed, `>` will not occur.
@@ -187,12 +755,51 @@ class Prefetcher(object):
       self.ep_done = True
     return samples, self.ep_done
 
+  def next_sample(self):
+    """Get the sample at `self.ptr` if `ordered`, otherwise whichever of the
+    current epoch comes first."""
+    pending = self.pending.setdefault(self.ep, {})
+    while True:
+      if self.ordered:
+        if self.ptr in pending:
+          return pending.pop(self.ptr)
+      elif len(pending) > 0:
+        return pending.popitem()[1]
+      if self.prefetch_stats is None:
+        ep, ptr, sample = self.enqueuer.get()
+      else:
+        ep, ptr, sample = self.timed_get()
+      if (ep == self.ep) and not self.ordered:
+        return sample
+      self.pending.setdefault(ep, {})[ptr] = sample
+
+  def timed_get(self):
+    """`enqueuer.get`, recording the waiting time and the queue depth."""
+    queue_depth = self.enqueuer.qsize()
+    st = time.time()
+    element = self.enqueuer.get()
+    self.prefetch_stats.add_get(time.time() - st, queue_depth)
+    return element
+
+  def stats(self):
+    """Timings since the creation or the last `reset_stats`, see
+    `PrefetchStats.summary`. Requires `collect_stats`."""
+    assert self.prefetch_stats is not None, \
+      'Create the Prefetcher with `collect_stats=True`'
+    return self.prefetch_stats.summary()
+
+  def reset_stats(self):
+    self.prefetch_stats.reset()
+
   def start_ep_prefetching(self):
     """
     NOTE: Has to be called at the start of every epoch.
     """
-    self.enqueuer.start_ep()
+    self.ep += 1
     self.ptr = 0
+    self.pending.pop(self.ep - 1, None)
+    last_ep = self.ep + 1 if self.overlap_epochs else self.ep
+    self.enqueuer.start_ep(self.ep, last_ep)
 
   def stop(self):
     """This can be called to stop threads, e.g. after finishing using the
@@ -1,34 +1,78 @@
 from __future__ import print_function
 import sys
 import time
+import hashlib
+import os.path as osp
+from functools import partial
 import scipy
 import scipy.io
-import os.path as osp
-from PIL import Image
 import numpy as np
 
 from .Dataset import Dataset
+from .FeatCache import FeatCache
 
 from ..utils.utils import measure_time
+from ..utils.utils import may_make_dir
+from ..utils.utils import available_memory_bytes
 from ..utils.re_ranking import re_ranking
+from ..utils.re_ranking import re_ranking_bytes
+from ..utils.retrieval import topk_rank_list
+from ..utils.ivf import IVFIndex
 from ..utils.metric import cmc, mean_ap
-from ..utils.dataset_utils import parse_im_name
+from ..utils.dataset_utils import parse_im_names
 from ..utils.distance import normalize
 from ..utils.distance import compute_dist
+from ..utils.distance import RowNormCache
 from ..utils.distance import local_dist
+from ..utils.distance import self_local_dist
 from ..utils.distance import low_memory_matrix_op
+from ..utils.distance import TilePlanner
+from ..utils.distance import compute_dist_pair_bytes
+from ..utils.distance import local_dist_pair_bytes
 
 import matplotlib.pyplot as plt
 
+# The axis along which each kind of feature is normalized when features are
+# normalized. Features not listed here are never normalized.
+FEAT_NORMALIZE_AXES = dict(global_feat=1, local_feat=-1)
+
+
 class TestSet(Dataset):
   """
   Args:
     extract_feat_func: a function to extract features. It takes a batch of
-      images and returns a batch of features.
+      images and returns a tuple of batches of features, named by
+      `feat_names`.
+    feat_names: the names of the outputs of `extract_feat_func`, in order,
+      e.g. ('feat', 'global_feat', 'local_feat').
     marks: a list, each element e denoting whether the image is from 
       query (e == 0), or
       gallery (e == 1), or 
       multi query (e == 2) set
+    im_ids, im_cams: (Optionally) the id and camera of each image, e.g. from
+      a `MetaIndex`; parsed from `im_names` if not given
+    im_store: (Optionally) an `ImageStore` to read images from
+    num_dist_workers: number of threads (or processes) computing local
+      distance in `eval`, see `low_memory_matrix_op`
+    dist_backend: 'thread' or 'process', see `low_memory_matrix_op`
+    dist_memory_mb: the memory budget of the distance matrices in `eval`,
+      on top of the features. Distances are computed in tiles that fit it,
+      and `eval` raises a `MemoryError` before computing any distance if the
+      matrices themselves, or the running top k of `retrieval_top_k` and a
+      gallery block of one sample, do not. If `None`, 80% of the memory
+      available when `eval` starts.
+    retrieval_top_k: (Optionally) score only the top k gallery samples of
+      each query in `eval`, streaming the gallery in blocks instead of
+      computing the query-gallery distance matrix, see `topk_rank_list`.
+      Only the global distance is scored then, since re-ranking and local
+      distance need whole distance matrices. mAP is defined as for whole
+      distance matrices, and is a lower bound of it if the top k miss some
+      matches. Single-gallery-shot CMC is only exact if k covers the
+      gallery; `eval` warns otherwise.
+    ivf_num_lists: (Optionally) with `retrieval_top_k`, search the gallery
+      approximately, with an `IVFIndex` of this many lists built in `eval`,
+      instead of exhaustively
+    ivf_nprobe: the number of lists searched per query, see `IVFIndex`
   """
 
   def __init__(
@@ -37,64 +81,105 @@ class TestSet(Dataset):
       im_names=None,
       marks=None,
       extract_feat_func=None,
+      feat_names=('feat', 'global_feat', 'local_feat'),
       separate_camera_set=None,
       single_gallery_shot=None,
       first_match_break=None,
+      im_ids=None,
+      im_cams=None,
+      im_store=None,
+      num_dist_workers=1,
+      dist_backend='thread',
+      dist_memory_mb=None,
+      retrieval_top_k=None,
+      ivf_num_lists=None,
+      ivf_nprobe=8,
       **kwargs):
 
     super(TestSet, self).__init__(dataset_size=len(im_names), **kwargs)
 
     # The im dir of all images
     self.im_dir = im_dir
+    self.im_store = im_store
     self.im_names = im_names
     self.marks = marks
+    if im_ids is None:
+      im_ids = parse_im_names(im_names, 'id')
+    if im_cams is None:
+      im_cams = parse_im_names(im_names, 'cam')
+    self.im_ids = np.asarray(im_ids)
+    self.im_cams = np.asarray(im_cams)
     self.extract_feat_func = extract_feat_func
+    self.feat_names = tuple(feat_names)
     self.separate_camera_set = separate_camera_set
     self.single_gallery_shot = single_gallery_shot
     self.first_match_break = first_match_break
-
-  def set_feat_func(self, extract_feat_func):
+    self.num_dist_workers = num_dist_workers
+    self.dist_backend = dist_backend
+    self.dist_memory_mb = dist_memory_mb
+    self.retrieval_top_k = retrieval_top_k
+    self.ivf_num_lists = ivf_num_lists
+    self.ivf_nprobe = ivf_nprobe
+
+  def set_feat_func(self, extract_feat_func, feat_names=None):
     self.extract_feat_func = extract_feat_func
-
-  def get_sample(self, ptr):
-    im_name = self.im_names[ptr]
-    im_path = osp.join(self.im_dir, im_name)
-    im = np.asarray(Image.open(im_path))
-    im, _ = self.pre_process_im(im)
-    id = parse_im_name(self.im_names[ptr], 'id')
-    cam = parse_im_name(self.im_names[ptr], 'cam')
+    if feat_names is not None:
+      self.feat_names = tuple(feat_names)
+
+  def get_sample(self, ptr, epoch):
+    ind = self.sample_index(ptr, epoch)
+    im_name = self.im_names[ind]
+    im = self.read_im(im_name)
+    im, _ = self.pre_process_im(im, prng=self.sample_prng(ptr, epoch))
+    id = self.im_ids[ind]
+    cam = self.im_cams[ind]
     # denoting whether the im is from query, gallery, or multi query set
-    mark = self.marks[ptr]
+    mark = self.marks[ind]
     return im, id, cam, im_name, mark
 
   def next_batch(self):
-    if self.epoch_done and self.shuffle:
-      self.prng.shuffle(self.im_names)
     samples, self.epoch_done = self.prefetcher.next_batch()
     im_list, ids, cams, im_names, marks = zip(*samples)
     # Transform the list into a numpy array with shape [N, ...]
-    ims = np.stack(im_list, axis=0)
+    ims = self.stack_ims(im_list)
     ids = np.array(ids)
     cams = np.array(cams)
     im_names = np.array(im_names)
     marks = np.array(marks)
     return ims, ids, cams, im_names, marks, self.epoch_done
 
-  def extract_feat(self, normalize_feat):
-    """Extract the features of the whole image set.
+  def extract_feat(self, normalize_feat,
+                   outputs=('global_feat', 'local_feat'), feat_dir=None):
+    """Extract the features of the whole image set. Each batch is written
+    (and normalized) straight into an array preallocated for the whole set,
+    so that features are never held twice.
     Args:
       normalize_feat: True or False, whether to normalize global and local 
         feature to unit length
+      outputs: the names, among `self.feat_names`, of the features to keep;
+        the others are dropped batch by batch
+      feat_dir: (Optionally) a directory to memory map the features to, one
+        `{name}.npy` file per output, so that their size is bounded by disk
+        rather than RAM. Existing files are overwritten.
     Returns:
-      global_feats: numpy array with shape [N, C]
-      local_feats: numpy array with shape [N, H, c]
+      feats: a dict mapping each name in `outputs` to a float numpy array
+        (or `numpy.memmap`) with shape [N, ...], e.g. [N, C] for
+        'global_feat' and [N, H, c] for 'local_feat'
       ids: numpy array with shape [N]
       cams: numpy array with shape [N]
       im_names: numpy array with shape [N]
       marks: numpy array with shape [N]
     """
-    feats, global_feats, local_feats, ids, cams, im_names, marks = \
-      [], [], [], [], [], [], []
+    for name in outputs:
+      assert name in self.feat_names, \
+        "Feature {} is not among the outputs {} of the extract function" \
+        .format(name, self.feat_names)
+    if feat_dir is not None:
+      may_make_dir(feat_dir)
+    num_ims = self.prefetcher.dataset_size
+    feats = {}
+    ids, cams, im_names, marks = [], [], [], []
+    num_done = 0
     done = False
     step = 0
     printed = False
@@ -102,10 +187,23 @@ class TestSet(Dataset):
     last_time = time.time()
     while not done:
       ims_, ids_, cams_, im_names_, marks_, done = self.next_batch()
-      feat, global_feat, local_feat = self.extract_feat_func(ims_)
-      feats.append(feat)
-      global_feats.append(global_feat)
-      local_feats.append(local_feat)
+      batch_feats = dict(zip(self.feat_names, self.extract_feat_func(ims_)))
+      for name in outputs:
+        feat = batch_feats[name]
+        if name not in feats:
+          shape = (num_ims,) + feat.shape[1:]
+          if feat_dir is None:
+            feats[name] = np.empty(shape, dtype=feat.dtype)
+          else:
+            feats[name] = np.lib.format.open_memmap(
+              osp.join(feat_dir, '{}.npy'.format(name)), mode='w+',
+              dtype=feat.dtype, shape=shape)
+        block = feats[name][num_done:num_done + len(feat)]
+        if normalize_feat and name in FEAT_NORMALIZE_AXES:
+          normalize(feat, axis=FEAT_NORMALIZE_AXES[name], out=block)
+        else:
+          block[...] = feat
+      num_done += len(ims_)
       ids.append(ids_)
       cams.append(cams_)
       im_names.append(im_names_)
@@ -126,27 +224,60 @@ class TestSet(Dataset):
                       time.time() - last_time, time.time() - st))
         last_time = time.time()
 
-    part_feats = feats[0:4]
-    part_feats = np.vstack(part_feats)
-    part_names = im_names[0:4]
-    part_names = np.hstack(part_names)
-    # Save to Matlab for check
-    print('start')
-    feat = {'feat':part_feats,'name':part_names}
-    scipy.io.savemat('./feat.mat',feat)
-    print('done')
-
-    global_feats = np.vstack(global_feats)
-    #local_feats = np.concatenate(local_feats)
-    local_feats = np.vstack(local_feats)
+    assert num_done == num_ims
+    for name in feats:
+      if isinstance(feats[name], np.memmap):
+        feats[name].flush()
+
+    if 'feat' in feats:
+      part_names = np.hstack(im_names[0:4])
+      part_feats = np.asarray(feats['feat'][:len(part_names)])
+      # Save to Matlab for check
+      print('start')
+      feat = {'feat':part_feats,'name':part_names}
+      scipy.io.savemat('./feat.mat',feat)
+      print('done')
+
     ids = np.hstack(ids)
     cams = np.hstack(cams)
     im_names = np.hstack(im_names)
     marks = np.hstack(marks)
-    if normalize_feat:
-      global_feats = normalize(global_feats, axis=1)
-      local_feats = normalize(local_feats, axis=-1)
-    return global_feats, local_feats, ids, cams, im_names, marks
+    return feats, ids, cams, im_names, marks
+
+  def feat_cache_key(self, model_key, normalize_feat):
+    """The key of this set's features in a `FeatCache`, given the model
+    weights identified by `model_key`. It also covers the images and
+    everything that changes how they are pre-processed."""
+    p = self.pre_process_im
+    to_tuple = lambda x: None if x is None else tuple(np.asarray(x).tolist())
+    im_names_md5 = hashlib.md5(
+      np.ascontiguousarray(self.im_names).tobytes()).hexdigest()
+    return FeatCache.make_key(
+      model_key,
+      (self.im_dir, len(self.im_names), im_names_md5,
+       self.im_store is not None, self.draft_w_h, self.seed),
+      (to_tuple(p.resize_h_w), p.crop_prob, p.crop_ratio, p.scale,
+       to_tuple(p.im_mean), to_tuple(p.im_std), p.mirror_type, p.batch_dims),
+      self.feat_names, normalize_feat)
+
+  def extract_feat_with_cache(self, feat_cache, model_key, normalize_feat,
+                              outputs):
+    """`extract_feat` through `feat_cache`. On a miss, all features that
+    `eval` may use are extracted and cached, not only `outputs`, so that
+    later calls with other settings also hit."""
+    key = self.feat_cache_key(model_key, normalize_feat)
+    ret = feat_cache.load(key, outputs)
+    if ret is not None:
+      print('Loaded features from {}'.format(feat_cache.entry_dir(key)))
+      return ret
+    cached_outputs = list(outputs) + [
+      name for name in self.feat_names
+      if (name in FEAT_NORMALIZE_AXES) and (name not in outputs)]
+    tmp_dir = feat_cache.tmp_entry_dir(key)
+    feats, ids, cams, im_names, marks = self.extract_feat(
+      normalize_feat, outputs=cached_outputs, feat_dir=tmp_dir)
+    feat_cache.commit(key, tmp_dir, ids, cams, im_names, marks)
+    return feats, ids, cams, im_names, marks
 
   @staticmethod
   def eval_map_cmc(
@@ -160,7 +291,7 @@ class TestSet(Dataset):
     """Compute CMC and mAP.
     Args:
       q_g_dist: numpy array with shape [num_query, num_gallery], the 
-        pairwise distance between query and gallery samples
+        pairwise distance between query and gallery samples, or a `RankList`
     Returns:
       mAP: numpy array with shape [num_query], the AP averaged across query 
         samples
@@ -190,17 +321,37 @@ class TestSet(Dataset):
       normalize_feat=True,
       use_local_distance=False,
       to_re_rank=True,
-      pool_type='average'):
+      pool_type='average',
+      feat_dir=None,
+      feat_cache=None,
+      model_key=None):
     """Evaluate using metric CMC and mAP.
     Args:
       normalize_feat: whether to normalize features before computing distance
       use_local_distance: whether to use local distance
       to_re_rank: whether to also report re-ranking scores
       pool_type: 'average' or 'max', only for multi-query case
+      feat_dir: (Optionally) a directory to memory map features to, see
+        `extract_feat`
+      feat_cache: (Optionally) a `FeatCache` to look features up in before
+        extracting them, and to store them in after. Replaces `feat_dir`.
+      model_key: a string identifying the model weights, e.g. the
+        `file_md5` of the checkpoint file; required with `feat_cache`
     """
+    outputs = ['global_feat']
+    if use_local_distance:
+      outputs.append('local_feat')
     with measure_time('Extracting feature...'):
-      global_feats, local_feats, ids, cams, im_names, marks = \
-        self.extract_feat(normalize_feat)
+      if feat_cache is None:
+        feats, ids, cams, im_names, marks = self.extract_feat(
+          normalize_feat, outputs=outputs, feat_dir=feat_dir)
+      else:
+        assert model_key is not None, \
+          'Cached features have to be keyed by the model weights'
+        feats, ids, cams, im_names, marks = self.extract_feat_with_cache(
+          feat_cache, model_key, normalize_feat, outputs)
+    global_feats = feats['global_feat']
+    local_feats = feats.get('local_feat')
 
     # query, gallery, multi-query indices
     q_inds = marks == 0
@@ -226,13 +377,115 @@ class TestSet(Dataset):
         topk=10)
       return mAP, cmc_scores
 
+    if self.dist_memory_mb is None:
+      budget_bytes = int(0.8 * available_memory_bytes())
+    else:
+      budget_bytes = int(self.dist_memory_mb * 1024 ** 2)
+    num_q, num_g = int(np.sum(q_inds)), int(np.sum(g_inds))
+
+    ####################
+    # Top-k Rank Lists #
+    ####################
+
+    if self.retrieval_top_k is not None:
+      if to_re_rank or use_local_distance:
+        print('Re-ranking and local distance are skipped, since they need '
+              'whole distance matrices, which retrieval_top_k avoids.')
+      k = min(self.retrieval_top_k, num_g)
+      if self.single_gallery_shot and k < num_g:
+        print('Warning: single-gallery-shot CMC of the top {} of {} gallery '
+              'samples may be lower than that of whole distance matrices, '
+              'since the chosen instance of the query id may not be among '
+              'them.'
+              .format(k, num_g))
+      if self.ivf_num_lists is not None:
+        g_global_feats = global_feats[g_inds]
+        with measure_time('Building an IVF index of {} lists...'
+                              .format(self.ivf_num_lists)):
+          index = IVFIndex(self.ivf_num_lists, nprobe=self.ivf_nprobe)
+          index.train(g_global_feats, prng=self.prng)
+          index.add(g_global_feats)
+        with measure_time('Searching the top {} gallery samples...'
+                              .format(k)):
+          rank_list = index.search(global_feats[q_inds], k)
+      else:
+        # Per gallery sample of a block, for each query: the float32
+        # distance, and the merged distance, index and `argpartition` index.
+        # The running top-k take the same per sample kept.
+        query_sample_bytes = 4 + 4 + 8 + 8
+        planner = TilePlanner(budget_bytes)
+        planner.hold(num_q * k * query_sample_bytes,
+                     'The running top {} of {} queries'.format(k, num_q))
+        planner.check(num_q * query_sample_bytes,
+                      'Ranking a block of one gallery sample')
+        block_size = (planner.budget_bytes - planner.held_bytes) \
+          // (num_q * query_sample_bytes)
+        with measure_time('Ranking the top {} gallery samples...'.format(k)):
+          rank_list = topk_rank_list(
+            partial(compute_dist, norm_cache=RowNormCache()),
+            global_feats[q_inds], global_feats[g_inds], k,
+            block_size=block_size, verbose=(block_size < num_g))
+      with measure_time('Computing scores for Global Distance...'):
+        mAP, cmc_scores = compute_score(rank_list)
+      return mAP, cmc_scores, None, None
+
+    ##########################
+    # Plan Distance Matrices #
+    ##########################
+
+    # Tiles of all distance matrices are planned before computing any, in
+    # the same order, so that what cannot fit fails right away.
+    planner = TilePlanner(budget_bytes, num_workers=self.num_dist_workers)
+    # Distances are computed in float32, and so are re-ranked ones.
+    g_itemsize = l_itemsize = re_r_itemsize = np.dtype(np.float32).itemsize
+    splits = {}
+
+    def plan_re_ranking(prefix, pair_bytes, itemsize):
+      splits[prefix + '_q_q'] = planner.plan(
+        num_q, num_q, pair_bytes, itemsize,
+        '{} query-query distance'.format(prefix.capitalize()))
+      splits[prefix + '_g_g'] = planner.plan(
+        num_g, num_g, pair_bytes, itemsize,
+        '{} gallery-gallery distance'.format(prefix.capitalize()))
+      planner.check(re_ranking_bytes(num_q, num_g), 'Re-ranking')
+      planner.hold(num_q * num_g * re_r_itemsize, 'Re-ranked distance')
+
+    g_pair_bytes = compute_dist_pair_bytes(g_itemsize)
+    splits['global_q_g'] = planner.plan(
+      num_q, num_g, g_pair_bytes, g_itemsize, 'Global query-gallery distance')
+    if to_re_rank:
+      plan_re_ranking('global', g_pair_bytes, g_itemsize)
+    if use_local_distance:
+      l_pair_bytes = local_dist_pair_bytes(
+        local_feats.shape[1], local_feats.shape[1], l_itemsize)
+      splits['local_q_g'] = planner.plan(
+        num_q, num_g, l_pair_bytes, l_itemsize, 'Local query-gallery distance')
+      if to_re_rank:
+        plan_re_ranking('local', l_pair_bytes, l_itemsize)
+      gl_itemsize = max(g_itemsize, l_itemsize)
+      planner.hold(num_q * num_g * gl_itemsize, 'Global+local distance')
+      if to_re_rank:
+        planner.hold((num_q ** 2 + num_g ** 2) * gl_itemsize,
+                     'Global+local query-query and gallery-gallery distance')
+        planner.check(re_ranking_bytes(num_q, num_g), 'Re-ranking')
+        planner.hold(num_q * num_g * re_r_itemsize, 'Re-ranked distance')
+
     # A helper function just for avoiding code duplication.
-    def low_memory_local_dist(x, y):
+    # For a distance of `x` to itself, `y` is `x` and `self_func` computes
+    # each symmetric pair once.
+    def low_memory_dist(func, x, y, name, self_func=None):
+      x_num_splits, y_num_splits = splits[name]
+      return low_memory_matrix_op(
+        func, x, y, 0, 0, x_num_splits, y_num_splits,
+        verbose=(x_num_splits * y_num_splits > 1),
+        num_workers=self.num_dist_workers, backend=self.dist_backend,
+        self_func=self_func)
+
+    # A helper function just for avoiding code duplication.
+    def low_memory_local_dist(x, y, name):
       with measure_time('Computing local distance...'):
-        x_num_splits = int(len(x) / 200) + 1
-        y_num_splits = int(len(y) / 200) + 1
-        z = low_memory_matrix_op(
-          local_dist, x, y, 0, 0, x_num_splits, y_num_splits, verbose=True)
+        z = low_memory_dist(local_dist, x, y, name,
+                            self_func=self_local_dist if y is x else None)
       return z
 
     ###################
@@ -241,10 +494,19 @@ class TestSet(Dataset):
     # query_feats = feats[q_inds]
     # query_names = im_names[q_inds]
 
+    q_global_feats = global_feats[q_inds]
+    g_global_feats = global_feats[g_inds]
+    # Row norms of the query and gallery parts are computed once, and reused
+    # by the query-query and gallery-gallery distances.
+    global_dist = partial(compute_dist, norm_cache=RowNormCache())
+    # The product of an array with itself is computed by numpy as a
+    # symmetric one, only once per pair.
+    global_self_dist = lambda x: global_dist(x, x)
+
     with measure_time('Computing global distance...'):
       # query-gallery distance using global distance
-      global_q_g_dist = compute_dist(
-        global_feats[q_inds], global_feats[g_inds], type='euclidean')
+      global_q_g_dist = low_memory_dist(
+        global_dist, q_global_feats, g_global_feats, 'global_q_g')
 
       # global_q_g_dist = compute_dist(
       #   local_feats[q_inds], local_feats[g_inds], type='euclidean')
@@ -255,15 +517,17 @@ class TestSet(Dataset):
     if to_re_rank:
       with measure_time('Re-ranking...'):
         # query-query distance using global distance
-        global_q_q_dist = compute_dist(
-          global_feats[q_inds], global_feats[q_inds], type='euclidean')
+        global_q_q_dist = low_memory_dist(
+          global_dist, q_global_feats, q_global_feats, 'global_q_q',
+          self_func=global_self_dist)
 
         # global_q_q_dist = compute_dist(
         #   local_feats[q_inds], local_feats[q_inds], type='euclidean')
 
         # gallery-gallery distance using global distance
-        global_g_g_dist = compute_dist(
-          global_feats[g_inds], global_feats[g_inds], type='euclidean')
+        global_g_g_dist = low_memory_dist(
+          global_dist, g_global_feats, g_global_feats, 'global_g_g',
+          self_func=global_self_dist)
 
         # global_g_g_dist = compute_dist(
         #   local_feats[g_inds], local_feats[g_inds], type='euclidean')
@@ -282,9 +546,12 @@ class TestSet(Dataset):
       # Local Distance #
       ##################
 
+      q_local_feats = local_feats[q_inds]
+      g_local_feats = local_feats[g_inds]
+
       # query-gallery distance using local distance
       local_q_g_dist = low_memory_local_dist(
-        local_feats[q_inds], local_feats[g_inds])
+        q_local_feats, g_local_feats, 'local_q_g')
 
       with measure_time('Computing scores for Local Distance...'):
         mAP, cmc_scores = compute_score(local_q_g_dist)
@@ -293,11 +560,11 @@ class TestSet(Dataset):
         with measure_time('Re-ranking...'):
           # query-query distance using local distance
           local_q_q_dist = low_memory_local_dist(
-            local_feats[q_inds], local_feats[q_inds])
+            q_local_feats, q_local_feats, 'local_q_q')
 
           # gallery-gallery distance using local distance
           local_g_g_dist = low_memory_local_dist(
-            local_feats[g_inds], local_feats[g_inds])
+            g_local_feats, g_local_feats, 'local_g_g')
 
           re_r_local_q_g_dist = re_ranking(
             local_q_g_dist, local_q_q_dist, local_g_g_dist)
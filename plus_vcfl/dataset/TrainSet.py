@@ -1,8 +1,6 @@
 from .Dataset import Dataset
-from ..utils.dataset_utils import parse_im_name
+from ..utils.dataset_utils import parse_im_names
 
-import os.path as osp
-from PIL import Image
 import numpy as np
 from collections import defaultdict
 
@@ -11,6 +9,14 @@ class TrainSet(Dataset):
   """Training set for triplet loss.
   Args:
     ids2labels: a dict mapping ids to labels
+    im_ids, im_cams: (Optionally) the id and camera of each image, e.g. from
+      a `MetaIndex`; parsed from `im_names` if not given
+    im_store: (Optionally) an `ImageStore` to read images from
+    cam_aware: if True, the `ims_per_id` images of an id are drawn from as
+      many distinct cameras as possible, cycling through its cameras in random
+      order, instead of uniformly from all its images.
+  After each `next_batch`, `cam_coverage` holds the camera coverage of the
+  batch, see `get_cam_coverage`.
   """
 
   def __init__(
@@ -20,50 +26,134 @@ class TrainSet(Dataset):
       ids2labels=None,
       ids_per_batch=None,
       ims_per_id=None,
+      im_ids=None,
+      im_cams=None,
+      im_store=None,
+      cam_aware=False,
       **kwargs):
 
     # The im dir of all images
     self.im_dir = im_dir
+    self.im_store = im_store
     self.im_names = im_names
     self.ids2labels = ids2labels
     self.ids_per_batch = ids_per_batch
     self.ims_per_id = ims_per_id
+    self.cam_aware = cam_aware
 
-    im_ids = [parse_im_name(name, 'id') for name in im_names]
-    self.ids_to_im_inds = defaultdict(list)    
-    for ind, id in enumerate(im_ids):
-      self.ids_to_im_inds[id].append(ind)
-    self.ids = self.ids_to_im_inds.keys()
+    if im_ids is None:
+      im_ids = parse_im_names(im_names, 'id')
+    if im_cams is None:
+      im_cams = parse_im_names(im_names, 'cam')
+    im_ids = np.asarray(im_ids)
+    self.im_cams = np.asarray(im_cams)
 
-    # im_cams = [parse_im_name(name, 'cam') for name in im_names]
-    # self.ids_to_cam_inds = defaultdict(list)    
-    # for ind, cam_id in enumerate(im_cams):
-    #   self.ids_to_cam_inds[cam_id].append(ind)
-    # self.cam_ids = self.ids_to_cam_inds.keys()    
+    # Image indices grouped by id, in ascending order.
+    order = np.argsort(im_ids, kind='mergesort')
+    ids, starts = np.unique(im_ids[order], return_index=True)
+    self.ids = ids.tolist()
+    ends = list(starts[1:]) + [len(order)]
+    self.ids_to_im_inds = dict(
+      (id, order[st:end]) for id, st, end in zip(self.ids, starts, ends))
+
+    # For each id, an array of image indices per camera.
+    order = np.lexsort((self.im_cams, im_ids))
+    starts = [0] + list(np.flatnonzero(
+      (np.diff(im_ids[order]) != 0) | (np.diff(self.im_cams[order]) != 0)) + 1)
+    ends = starts[1:] + [len(order)]
+    self.ids_to_cam_inds = defaultdict(list)
+    for id, st, end in zip(im_ids[order[starts]].tolist(), starts, ends):
+      self.ids_to_cam_inds[id].append(order[st:end])
+    # The most distinct cameras `ims_per_id` images of a label can cover.
+    self.labels_to_max_cams = dict(
+      (ids2labels[id], min(len(cam_inds), ims_per_id))
+      for id, cam_inds in self.ids_to_cam_inds.items())
+    self.cam_coverage = None
 
     super(TrainSet, self).__init__(
       dataset_size=len(self.ids),
       batch_size=ids_per_batch,
       **kwargs)
 
-  def get_sample(self, ptr):
+  def get_sample(self, ptr, epoch):
     """Here one sample means several images (and labels etc) of one id.
     Returns:
-      ims: a list of images
+      ims: numpy array with shape [ims_per_id, C, H, W] or [ims_per_id, H, W, C]
     """
-    inds = self.ids_to_im_inds[self.ids[ptr]]
-    if len(inds) < self.ims_per_id:
-      inds = np.random.choice(inds, self.ims_per_id, replace=True)
+    prng = self.sample_prng(ptr, epoch)
+    id = self.ids[self.sample_index(ptr, epoch)]
+    if self.cam_aware:
+      inds = self.sample_across_cams(
+        self.ids_to_cam_inds[id], np.random if prng is None else prng)
     else:
-      inds = np.random.choice(inds, self.ims_per_id, replace=False)
+      choice = np.random.choice if prng is None else prng.choice
+      inds = self.ids_to_im_inds[id]
+      if len(inds) < self.ims_per_id:
+        inds = choice(inds, self.ims_per_id, replace=True)
+      else:
+        inds = choice(inds, self.ims_per_id, replace=False)
     im_names = [self.im_names[ind] for ind in inds]
-    cam_labels = [parse_im_name(im_names[i], 'cam') for i in range(len(im_names))]
-    ims = [np.asarray(Image.open(osp.join(self.im_dir, name)))
-           for name in im_names]
-    ims, mirrored = zip(*[self.pre_process_im(im) for im in ims])
-    labels = [self.ids2labels[self.ids[ptr]] for _ in range(self.ims_per_id)]   
+    cam_labels = self.im_cams[inds]
+    ims = [self.read_im(name) for name in im_names]
+    ims, mirrored = self.pre_process_im.pre_process_ims(ims, prng=prng)
+    labels = [self.ids2labels[id] for _ in range(self.ims_per_id)]   
     return ims, im_names, labels, cam_labels, mirrored
 
+  def sample_across_cams(self, cam_inds, prng):
+    """Draw `ims_per_id` image indices, cycling through the cameras in a
+    random order, so that min(ims_per_id, len(cam_inds)) distinct cameras
+    are covered. Within a camera, images are drawn without replacement by a
+    partial Fisher-Yates shuffle of its offsets, so each draw takes one
+    random number. A camera that runs out leaves the cycle; only if all run
+    out, images are repeated.
+    Args:
+      cam_inds: a list of arrays, the image indices of each camera of an id
+      prng: the random number generator to draw from
+    """
+    cams = list(prng.permutation(len(cam_inds)))
+    # The first `num_left[cam]` positions of camera `cam`'s shuffle hold the
+    # offsets not drawn yet; a drawn one is swapped with the last of them.
+    # Only swapped positions are stored, the others hold their own offset.
+    swapped = [{} for _ in cam_inds]
+    num_left = [len(c) for c in cam_inds]
+    inds = []
+    i = 0
+    while len(inds) < self.ims_per_id:
+      if len(cams) == 0:
+        # Fewer images than `ims_per_id`.
+        cam = prng.randint(len(cam_inds))
+        inds.append(cam_inds[cam][prng.randint(len(cam_inds[cam]))])
+        continue
+      i %= len(cams)
+      cam = cams[i]
+      pos = prng.randint(num_left[cam])
+      last = num_left[cam] - 1
+      offset = swapped[cam].get(pos, pos)
+      swapped[cam][pos] = swapped[cam].get(last, last)
+      num_left[cam] = last
+      inds.append(cam_inds[cam][offset])
+      if num_left[cam] == 0:
+        del cams[i]
+      else:
+        i += 1
+    return inds
+
+  def get_cam_coverage(self, labels, cam_labels):
+    """Camera coverage of a batch.
+    Args:
+      labels, cam_labels: lists with an array per id, as in the samples
+    Returns:
+      a dict of
+      cams_per_id: the mean number of distinct cameras of an id
+      coverage: the distinct cameras over the most that `ims_per_id` images
+        of the ids could cover, 1 meaning every id covers as many cameras as
+        possible
+    """
+    num_cams = [len(set(cams)) for cams in cam_labels]
+    max_cams = [self.labels_to_max_cams[l[0]] for l in labels]
+    return dict(cams_per_id=np.mean(num_cams),
+                coverage=np.sum(num_cams) / float(np.sum(max_cams)))
+
   def next_batch(self):
     """Next batch of images and labels.
     Returns:
@@ -73,14 +163,12 @@ class TrainSet(Dataset):
       mirrored: a numpy array of booleans, whether the images are mirrored
       self.epoch_done: whether the epoch is over
     """
-    # Start enqueuing and other preparation at the beginning of an epoch.
-    if self.epoch_done and self.shuffle:
-      np.random.shuffle(self.ids)
     samples, self.epoch_done = self.prefetcher.next_batch()
     im_list, im_names, labels, cam_labels, mirrored = zip(*samples)
+    self.cam_coverage = self.get_cam_coverage(labels, cam_labels)
     # t = time.time()
     # Transform the list into a numpy array with shape [N, ...]
-    ims = np.stack(np.concatenate(im_list))
+    ims = self.stack_ims([im for ims_ in im_list for im in ims_])
     # print '---stacking time {:.4f}s'.format(time.time() - t)
     im_names = np.concatenate(im_names)
     labels = np.concatenate(labels)
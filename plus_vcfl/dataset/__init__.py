@@ -3,22 +3,18 @@ import os.path as osp
 ospj = osp.join
 ospeu = osp.expanduser
 
-from ..utils.utils import load_pickle
-from ..utils.dataset_utils import parse_im_name
 from .TrainSet import TrainSet
 from .TestSet import TestSet
+from .ImageStore import ImageStore
+from .ImageStore import get_im_store_file
+from .MetaIndex import load_meta_index
 
 
-def create_dataset(
-    name='market1501',
-    part='trainval',
-    **kwargs):
+def get_dataset_paths(name='market1501'):
+  """Returns the image directory and the partition file of a dataset."""
   assert name in ['market1501', 'cuhk03', 'duke', 'combined'], \
     "Unsupported Dataset {}".format(name)
 
-  assert part in ['trainval', 'train', 'val', 'test'], \
-    "Unsupported Dataset Part {}".format(part)
-
   ########################################
   # Specify Directory and Partition File #
   ########################################
@@ -37,11 +33,42 @@ def create_dataset(
     partition_file = ospeu('./Dataset/duke/partitions.pkl')
 
   elif name == 'combined':
-    assert part in ['trainval'], \
-      "Only trainval part of the combined dataset is available now."
     im_dir = ospeu('./Dataset/market1501_cuhk03_duke/trainval_images')
     partition_file = ospeu('./Dataset/market1501_cuhk03_duke/partitions.pkl')
 
+  return im_dir, partition_file
+
+
+def create_dataset(
+    name='market1501',
+    part='trainval',
+    use_im_store=False,
+    **kwargs):
+  """
+  Args:
+    use_im_store: whether to read images from the packed image store built by
+      script/dataset/pack_images.py, instead of decoding JPEG files. The store
+      must have been built with the same `resize_h_w`.
+  """
+  assert name in ['market1501', 'cuhk03', 'duke', 'combined'], \
+    "Unsupported Dataset {}".format(name)
+
+  assert part in ['trainval', 'train', 'val', 'test'], \
+    "Unsupported Dataset Part {}".format(part)
+
+  if name == 'combined':
+    assert part in ['trainval'], \
+      "Only trainval part of the combined dataset is available now."
+
+  im_dir, partition_file = get_dataset_paths(name)
+
+  if use_im_store:
+    resize_h_w = kwargs.get('resize_h_w')
+    assert resize_h_w is not None, \
+      "The image store holds resized images, `resize_h_w` is required."
+    kwargs['im_store'] = ImageStore(
+      get_im_store_file(partition_file, resize_h_w))
+
   ##################
   # Create Dataset #
   ##################
@@ -51,55 +78,41 @@ def create_dataset(
                     single_gallery_shot=False,
                     first_match_break=True)
 
-  partitions = load_pickle(partition_file)
-  im_names = partitions['{}_im_names'.format(part)]
-
-  if part == 'trainval':
-    ids2labels = partitions['trainval_ids2labels']
-
-    ret_set = TrainSet(
-      im_dir=im_dir,
-      im_names=im_names,
-      ids2labels=ids2labels,
-      **kwargs)
+  # Ids, cameras etc. are read from the columnar index next to the partition
+  # file, which is built on first use.
+  index = load_meta_index(partition_file, part)
+  im_names = index.im_names
 
-  elif part == 'train':
-    ids2labels = partitions['train_ids2labels']
+  if part in ['trainval', 'train']:
+    ids2labels = index.ids2labels
 
     ret_set = TrainSet(
       im_dir=im_dir,
       im_names=im_names,
       ids2labels=ids2labels,
+      im_ids=index.ids,
+      im_cams=index.cams,
       **kwargs)
 
-  elif part == 'val':
-    marks = partitions['val_marks']
-    kwargs.update(cmc_kwargs)
-
-    ret_set = TestSet(
-      im_dir=im_dir,
-      im_names=im_names,
-      marks=marks,
-      **kwargs)
-
-  elif part == 'test':
-    marks = partitions['test_marks']
+  elif part in ['val', 'test']:
+    marks = index.marks
     kwargs.update(cmc_kwargs)
 
     ret_set = TestSet(
       im_dir=im_dir,
       im_names=im_names,
       marks=marks,
+      im_ids=index.ids,
+      im_cams=index.cams,
       **kwargs)
 
   if part in ['trainval', 'train']:
     num_ids = len(ids2labels)
   elif part in ['val', 'test']:
-    ids = [parse_im_name(n, 'id') for n in im_names]
-    num_ids = len(list(set(ids)))
-    num_query = np.sum(np.array(marks) == 0)
-    num_gallery = np.sum(np.array(marks) == 1)
-    num_multi_query = np.sum(np.array(marks) == 2)
+    num_ids = len(np.unique(index.ids))
+    num_query = np.sum(marks == 0)
+    num_gallery = np.sum(marks == 1)
+    num_multi_query = np.sum(marks == 2)
 
   # Print dataset information
   print('-' * 40)
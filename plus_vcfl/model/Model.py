@@ -4,6 +4,7 @@ import torch.nn.init as init
 import torch.nn.functional as F
 
 from .resnet import resnet50
+from .basic_layers import InputNormalization
 
 
 class GradReverse(torch.autograd.Function):
@@ -30,8 +31,17 @@ class domain_classifier(nn.Module):
         return torch.sigmoid(x)
 
 class Model(nn.Module):
-  def __init__(self, local_conv_out_channels=128, num_classes=None, cam_classes=None):
+  def __init__(self, local_conv_out_channels=128, num_classes=None, cam_classes=None,
+               im_mean=None, im_std=None):
+    """
+    Args:
+      im_mean, im_std: if given, the model takes unnormalized (e.g. uint8)
+        images and normalizes them itself, as `PreProcessIm` would do with
+        `scale=True`.
+    """
     super(Model, self).__init__()
+    if im_mean is not None:
+      self.input_norm = InputNormalization(im_mean, im_std)
     self.base = resnet50(pretrained=True)
     planes = 2048
     self.local_conv = nn.Conv2d(planes, local_conv_out_channels, 1)
@@ -54,6 +64,8 @@ class Model(nn.Module):
       global_feat: shape [N, C]
       local_feat: shape [N, H, c]
     """
+    if hasattr(self, 'input_norm'):
+      x = self.input_norm(x)
     # shape [N, C, H, W]
     feat = self.base(x)
     global_feat = F.avg_pool2d(feat, feat.size()[2:])
@@ -36,4 +36,24 @@ class ResidualBlock(nn.Module):
         if (self.input_channels != self.output_channels) or (self.stride !=1 ):
             residual = self.conv4(out1)
         out += residual
-        return out
\ No newline at end of file
+        return out
+
+class InputNormalization(nn.Module):
+    """Scale by 1/255, subtract mean and divide by std, as one fused float32
+    op `x * weight + bias`. It lets the data pipeline ship uint8 images.
+    Args:
+      im_mean: a tuple or list or numpy array with shape [3]
+      im_std: a tuple or list or numpy array with shape [3]
+    """
+    def __init__(self, im_mean, im_std):
+        super(InputNormalization, self).__init__()
+        im_mean = np.array(im_mean, dtype=np.float32)
+        im_std = np.array(im_std, dtype=np.float32)
+        # shape [1, 3, 1, 1], to broadcast over 'NCHW' batches
+        self.register_buffer(
+            'weight', torch.from_numpy(1. / (255. * im_std)).view(1, -1, 1, 1))
+        self.register_buffer(
+            'bias', torch.from_numpy(-im_mean / im_std).view(1, -1, 1, 1))
+
+    def forward(self, x):
+        return torch.addcmul(self.bias, x.float(), self.weight)
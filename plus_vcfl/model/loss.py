@@ -1,5 +1,6 @@
 from __future__ import print_function
 import torch
+from torch.autograd.function import once_differentiable
 import numpy as np
 
 def normalize(x, axis=-1):
@@ -54,6 +55,65 @@ def batch_euclidean_dist(x, y):
   return dist
 
 
+class ShortestDist(torch.autograd.Function):
+  """The shortest path from the top left to the bottom right of `dist_mat`,
+  moving down or right, with the dynamic programming table filled by in-place
+  tensor ops, instead of one autograd node per cell. The backward pass walks
+  the table back from the bottom right cell, giving each cell of
+  `dist_mat` the gradient of the final distance w.r.t. it. Ties pass the
+  gradient to the cell on the left, as the backward of
+  `torch.min(up, left)` does, so values and gradients are identical to
+  building the graph cell by cell."""
+
+  @staticmethod
+  def forward(ctx, dist_mat):
+    m, n = dist_mat.size()[:2]
+    dist = dist_mat.new(dist_mat.size())
+    # Views of all cells, created at once; indexing a tensor per cell would
+    # cost more than the arithmetic.
+    cells = [row.unbind(0) for row in dist.unbind(0)]
+    costs = [row.unbind(0) for row in dist_mat.unbind(0)]
+    cells[0][0].copy_(costs[0][0])
+    for j in range(1, n):
+      torch.add(cells[0][j - 1], costs[0][j], out=cells[0][j])
+    for i in range(1, m):
+      torch.add(cells[i - 1][0], costs[i][0], out=cells[i][0])
+      for j in range(1, n):
+        torch.min(cells[i - 1][j], cells[i][j - 1], out=cells[i][j])
+        cells[i][j].add_(costs[i][j])
+    ctx.save_for_backward(dist)
+    return cells[-1][-1].clone()
+
+  @staticmethod
+  @once_differentiable
+  def backward(ctx, grad_output):
+    dist, = ctx.saved_tensors
+    m, n = dist.size()[:2]
+    # Whether the cell above is not taken, and whether the cell on the left is
+    # not taken, for cells [1:, 1:], as masked by the backward of `torch.min`.
+    up_not_taken = [row.unbind(0) for row in
+                    (dist[:-1, 1:] >= dist[1:, :-1]).unbind(0)]
+    left_not_taken = [row.unbind(0) for row in
+                      (dist[:-1, 1:] < dist[1:, :-1]).unbind(0)]
+    # The gradient w.r.t. each cell of the table, which is also the gradient
+    # w.r.t. the same cell of `dist_mat`.
+    grad = dist.new(dist.size()).zero_()
+    grads = [row.unbind(0) for row in grad.unbind(0)]
+    grads[-1][-1].copy_(grad_output)
+    for i in range(m - 1, -1, -1):
+      for j in range(n - 1, -1, -1):
+        if (i > 0) and (j > 0):
+          grads[i - 1][j].add_(
+            grads[i][j].masked_fill(up_not_taken[i - 1][j - 1], 0))
+          grads[i][j - 1].add_(
+            grads[i][j].masked_fill(left_not_taken[i - 1][j - 1], 0))
+        elif i > 0:
+          grads[i - 1][j].add_(grads[i][j])
+        elif j > 0:
+          grads[i][j - 1].add_(grads[i][j])
+    return grad
+
+
 def shortest_dist(dist_mat):
   """Parallel version.
   Args:
@@ -67,21 +127,7 @@ def shortest_dist(dist_mat):
       2) pytorch Variable, with shape [N]
       3) pytorch Variable, with shape [*]
   """
-  m, n = dist_mat.size()[:2]
-  # Just offering some reference for accessing intermediate distance.
-  dist = [[0 for _ in range(n)] for _ in range(m)]
-  for i in range(m):
-    for j in range(n):
-      if (i == 0) and (j == 0):
-        dist[i][j] = dist_mat[i, j]
-      elif (i == 0) and (j > 0):
-        dist[i][j] = dist[i][j - 1] + dist_mat[i, j]
-      elif (i > 0) and (j == 0):
-        dist[i][j] = dist[i - 1][j] + dist_mat[i, j]
-      else:
-        dist[i][j] = torch.min(dist[i - 1][j], dist[i][j - 1]) + dist_mat[i, j]
-  dist = dist[-1][-1]
-  return dist
+  return ShortestDist.apply(dist_mat)
 
 
 def local_dist(x, y):
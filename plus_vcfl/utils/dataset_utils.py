@@ -17,6 +17,36 @@ def parse_im_name(im_name, parse_type='id'):
   return parsed
 
 
+def parse_im_names(im_names, parse_type='id'):
+  """Get the person ids or cams of image names in the `new_im_name_tmpl`
+  format, all at once. The digits are read from the byte (or code point) view
+  of a fixed-width string array, instead of calling `int()` per name.
+  Args:
+    im_names: a list or numpy array of image names
+    parse_type: 'id' or 'cam'
+  Returns:
+    a numpy array of int64
+  """
+  assert parse_type in ('id', 'cam')
+  im_names = np.ascontiguousarray(im_names)
+  if len(im_names) == 0:
+    return np.zeros(0, dtype=np.int64)
+  assert im_names.dtype.kind in ('S', 'U')
+  char_type = np.uint32 if im_names.dtype.kind == 'U' else np.uint8
+  chars = im_names.view(char_type).reshape(len(im_names), -1)
+  assert chars.shape[1] >= 13, 'Image names are not in the expected format'
+  start, stop = (0, 8) if parse_type == 'id' else (9, 13)
+  digits = chars[:, start:stop].astype(np.int64) - ord('0')
+  # Negative ids, e.g. -1 for distractors, are formatted like '-0000001'.
+  negative = chars[:, start] == ord('-')
+  digits[negative, 0] = 0
+  assert ((digits >= 0) & (digits <= 9)).all(), \
+    'Image names are not in the expected format'
+  parsed = digits.dot(10 ** np.arange(stop - start - 1, -1, -1))
+  parsed[negative] *= -1
+  return parsed
+
+
 def get_im_names(im_dir, pattern='*.jpg', return_np=True, return_path=False):
   """Get the image names in a dir. Optional to return numpy array, paths."""
   im_paths = glob.glob(osp.join(im_dir, pattern))
@@ -42,12 +72,14 @@ def move_ims(ori_im_paths, new_im_dir, parse_im_name, new_im_name_tmpl):
   return new_im_names
 
 
-def partition_train_val_set(im_names, parse_im_name,
+def partition_train_val_set(im_names, parse_im_name=None,
                             num_val_ids=None, val_prop=None, seed=1):
   """Partition the trainval set into train and val set. 
   Args:
     im_names: trainval image names
-    parse_im_name: a function to parse id and camera from image name
+    parse_im_name: a function to parse id and camera from image name. If
+      `None`, names are in the `new_im_name_tmpl` format and parsed by
+      `parse_im_names`.
     num_val_ids: number of ids for val set. If not set, val_prob is used.
     val_prop: the proportion of validation ids
     seed: the random seed to reproduce the partition results. If not to use, 
@@ -62,8 +94,12 @@ def partition_train_val_set(im_names, parse_im_name,
   if not isinstance(im_names, np.ndarray):
     im_names = np.array(im_names)
   np.random.shuffle(im_names)
-  ids = np.array([parse_im_name(n, 'id') for n in im_names])
-  cams = np.array([parse_im_name(n, 'cam') for n in im_names])
+  if parse_im_name is None:
+    ids = parse_im_names(im_names, 'id')
+    cams = parse_im_names(im_names, 'cam')
+  else:
+    ids = np.array([parse_im_name(n, 'id') for n in im_names])
+    cams = np.array([parse_im_name(n, 'cam') for n in im_names])
   unique_ids = np.unique(ids)
   np.random.shuffle(unique_ids)
 
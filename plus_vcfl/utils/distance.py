@@ -4,37 +4,94 @@ the meaning of these methods."""
 import numpy as np
 
 
-def normalize(nparray, order=2, axis=0):
-  """Normalize a N-D numpy array along the specified axis."""
+def normalize(nparray, order=2, axis=0, out=None):
+  """Normalize a N-D numpy array along the specified axis. If `out` is given,
+  e.g. `nparray` itself or a slice of a memory-mapped array, the result is
+  written into it."""
   norm = np.linalg.norm(nparray, ord=order, axis=axis, keepdims=True)
-  return nparray / (norm + np.finfo(np.float32).eps)
+  norm += np.finfo(np.float32).eps
+  return np.divide(nparray, norm, out=out)
 
 
-def compute_dist(array1, array2, type='euclidean'):
-  """Compute the euclidean or cosine distance of all pairs.
+class RowNormCache(object):
+  """Squared L2 norms of the rows of arrays seen before, e.g. the gallery
+  parts of `low_memory_matrix_op`, which are paired with every query part.
+  Arrays are recognized by their memory, shape and strides, and are kept
+  alive by the cache so that their memory is not reused by other arrays.
+  They must not be modified while cached."""
+
+  def __init__(self):
+    self._entries = {}
+
+  def sq_norms(self, array, dtype=None):
+    """Returns numpy array with shape [m], for `array` with shape [m, n],
+    computed in `dtype` if given."""
+    key = (array.__array_interface__['data'][0], array.shape, array.strides,
+           array.dtype.str, np.dtype(dtype).str if dtype else None)
+    entry = self._entries.get(key)
+    if entry is None:
+      entry = (array, row_sq_norms(np.asarray(array, dtype=dtype)))
+      self._entries[key] = entry
+    return entry[1]
+
+  def clear(self):
+    self._entries.clear()
+
+
+def row_sq_norms(array):
+  """Squared L2 norms of the rows of `array` with shape [m, n], shape [m]."""
+  return np.sum(np.square(array), axis=1)
+
+
+def compute_dist(array1, array2, type='euclidean', out=None, norm_cache=None,
+                 dtype=np.float32):
+  """Compute the euclidean or cosine distance of all pairs. The distances are
+  computed in place in the result, which is the only matrix allocated.
   Args:
     array1: numpy array with shape [m1, n]
     array2: numpy array with shape [m2, n]
-    type: one of ['cosine', 'euclidean']
+    type: one of ['cosine', 'euclidean']. The cosine distance is one minus
+      the cosine similarity.
+    out: optional numpy array with shape [m1, m2] and type `dtype`, e.g. a
+      slice of a larger matrix, to write the result into
+    norm_cache: optional `RowNormCache`, to reuse the row norms of arrays
+      passed before, e.g. a gallery compared with many queries
+    dtype: the type to compute in, inputs of other types are converted;
+      `None` to compute in the type of the inputs
   Returns:
-    numpy array with shape [m1, m2]
+    numpy array with shape [m1, m2], `out` if given
   """
   assert type in ['cosine', 'euclidean']
+  if norm_cache is not None:
+    # Looked up by the arrays as given, before any conversion.
+    sq_norms1 = norm_cache.sq_norms(array1, dtype)
+    sq_norms2 = norm_cache.sq_norms(array2, dtype)
+  array1 = np.asarray(array1, dtype=dtype)
+  array2 = np.asarray(array2, dtype=dtype)
+  if norm_cache is None:
+    sq_norms1, sq_norms2 = row_sq_norms(array1), row_sq_norms(array2)
+  dist = np.matmul(array1, array2.T, out=out)
   if type == 'cosine':
-    array1 = normalize(array1, axis=1)
-    array2 = normalize(array2, axis=1)
-    dist = np.matmul(array1, array2.T)
-    return dist
+    eps = np.finfo(np.float32).eps
+    dist /= (np.sqrt(sq_norms1) + eps)[..., np.newaxis]
+    dist /= (np.sqrt(sq_norms2) + eps)[np.newaxis, ...]
+    np.subtract(1, dist, out=dist)
   else:
-    # shape [m1, 1]
-    square1 = np.sum(np.square(array1), axis=1)[..., np.newaxis]
-    # shape [1, m2]
-    square2 = np.sum(np.square(array2), axis=1)[np.newaxis, ...]
-    squared_dist = - 2 * np.matmul(array1, array2.T) + square1 + square2
-    squared_dist[squared_dist < 0] = 0
-    dist = np.sqrt(squared_dist)
-    #dist = np.exp(-1 * dist)
-    return dist
+    euclidean_from_product(
+      dist, sq_norms1[..., np.newaxis], sq_norms2[np.newaxis, ...])
+  return dist
+
+
+def euclidean_from_product(dist, sq_norms1, sq_norms2):
+  """Turn products x * y into euclidean distances in place, given squared
+  norms that broadcast to the shape of `dist`."""
+  # -2 * x * y + x^2 + y^2, in the same order as before
+  dist *= -2
+  dist += sq_norms1
+  dist += sq_norms2
+  np.maximum(dist, 0, out=dist)
+  np.sqrt(dist, out=dist)
+  return dist
 
 
 def shortest_dist(dist_mat):
@@ -50,27 +107,37 @@ def shortest_dist(dist_mat):
       2) numpy array, with shape [N]
       3) numpy array with shape [*]
   """
+  if dist_mat.ndim == 2:
+    return shortest_dist(dist_mat[..., np.newaxis])[0]
   m, n = dist_mat.shape[:2]
-  dist = np.zeros_like(dist_mat)
-  for i in range(m):
-    for j in range(n):
-      if (i == 0) and (j == 0):
-        dist[i, j] = dist_mat[i, j]
-      elif (i == 0) and (j > 0):
-        dist[i, j] = dist[i, j - 1] + dist_mat[i, j]
-      elif (i > 0) and (j == 0):
-        dist[i, j] = dist[i - 1, j] + dist_mat[i, j]
-      else:
-        dist[i, j] = \
-          np.min(np.stack([dist[i - 1, j], dist[i, j - 1]], axis=0), axis=0) \
-          + dist_mat[i, j]
-  # I ran into memory disaster when returning this reference! I still don't
-  # know why.
-  # dist = dist[-1, -1]
-  dist = dist[-1, -1].copy()
+  # Only one row of the table is kept, and updated in place from top to
+  # bottom: before updating cell j of row i, `row[j]` holds dist[i - 1, j] and
+  # `row[j - 1]` holds dist[i, j - 1]. Each cell is computed by the same
+  # float operations as filling the full table, so results are identical.
+  row = np.empty_like(dist_mat[0])
+  row[0] = dist_mat[0, 0]
+  for j in range(1, n):
+    np.add(row[j - 1], dist_mat[0, j], out=row[j])
+  for i in range(1, m):
+    row[0] += dist_mat[i, 0]
+    for j in range(1, n):
+      np.minimum(row[j - 1], row[j], out=row[j])
+      row[j] += dist_mat[i, j]
+  # Copy, not to keep the whole row alive through a view.
+  dist = row[-1].copy()
   return dist
 
 
+def squash_dist(dist_mat):
+  """Map distances to [0, 1) by (e^x - 1) / (e^x + 1), computing the
+  exponential once and reusing its buffer."""
+  exp = np.exp(dist_mat)
+  dist_mat = exp - 1.
+  exp += 1.
+  dist_mat /= exp
+  return dist_mat
+
+
 def meta_local_dist(x, y):
   """
   Args:
@@ -80,7 +147,7 @@ def meta_local_dist(x, y):
     dist: scalar
   """
   eu_dist = compute_dist(x, y, 'euclidean')
-  dist_mat = (np.exp(eu_dist) - 1.) / (np.exp(eu_dist) + 1.)
+  dist_mat = squash_dist(eu_dist)
   dist = shortest_dist(dist_mat[np.newaxis])[0]
   return dist
 
@@ -116,7 +183,7 @@ def parallel_local_dist(x, y):
   y = y.reshape([N * n, d])
   # shape [M * m, N * n]
   dist_mat = compute_dist(x, y, type='euclidean')
-  dist_mat = (np.exp(dist_mat) - 1.) / (np.exp(dist_mat) + 1.)
+  dist_mat = squash_dist(dist_mat)
   # shape [M * m, N * n] -> [M, m, N, n] -> [m, n, M, N]
   dist_mat = dist_mat.reshape([M, m, N, n]).transpose([1, 3, 0, 2])
   # shape [M, N]
@@ -133,12 +200,145 @@ def local_dist(x, y):
     raise NotImplementedError('Input shape not supported.')
 
 
+def self_local_dist(x):
+  """`local_dist(x, x)`, running the shortest path only once per pair of
+  inputs, i.e. for pairs (i, j) with i <= j, and mirroring the rest.
+  Args:
+    x: numpy array, with shape [M, m, d]
+  Returns:
+    dist: numpy array, with shape [M, M]
+  """
+  M, m, d = x.shape
+  x = np.asarray(x.reshape([M * m, d]), dtype=np.float32)
+  # shape [M * m, M * m], which numpy computes as a symmetric product
+  prod = np.matmul(x, x.T).reshape(-1)
+  rows, cols = np.triu_indices(M)
+  # shape [m, m, P], for the P pairs on and above the diagonal. Gathered
+  # stripe by stripe, to be contiguous along pairs for `shortest_dist`.
+  dist_mat = np.empty([m, m, len(rows)], dtype=prod.dtype)
+  pair_offsets = rows * (m * M * m) + cols * m
+  for i in range(m):
+    for j in range(m):
+      np.take(prod, pair_offsets + (i * M * m + j), out=dist_mat[i, j])
+  del prod
+  # The same as `compute_dist` and `squash_dist` do for all pairs.
+  sq_norms = row_sq_norms(x).reshape([M, m])
+  euclidean_from_product(
+    dist_mat, sq_norms[rows].T[:, np.newaxis], sq_norms[cols].T[np.newaxis])
+  dist_mat = squash_dist(dist_mat)
+  # shape [P]
+  pair_dist = shortest_dist(dist_mat)
+  dist = np.empty([M, M], dtype=pair_dist.dtype)
+  dist[rows, cols] = pair_dist
+  dist[cols, rows] = pair_dist
+  return dist
+
+
+def compute_dist_pair_bytes(itemsize):
+  """Working memory of `compute_dist` per pair of inputs, besides the result,
+  for distances of `itemsize` bytes. Distances are computed in place in the
+  result, so it is none."""
+  return 0
+
+
+def local_dist_pair_bytes(m, n, itemsize):
+  """Working memory of `local_dist` per pair of inputs, besides the result,
+  for inputs with `m` and `n` stripes: the [m, n] stripe distances, their
+  temporaries and the row of `shortest_dist`."""
+  return 5 * m * n * itemsize
+
+
+class TilePlanner(object):
+  """Chooses the splits of `low_memory_matrix_op` for a sequence of matrix
+  ops, so that the matrices kept so far, the result of the op and the tiles
+  being computed all fit in a memory budget. Planning all ops before
+  computing any of them makes a run that cannot fit fail right away, instead
+  of running out of memory half way."""
+
+  def __init__(self, budget_bytes, num_workers=1):
+    """
+    Args:
+      budget_bytes: memory available to the planned ops and their results
+      num_workers: number of tiles computed at the same time
+    """
+    self.budget_bytes = budget_bytes
+    self.num_workers = max(1, num_workers)
+    self.held_bytes = 0
+
+  def _raise(self, what, needed_bytes):
+    raise MemoryError(
+      '{} needs at least {:.1f} MB, on top of {:.1f} MB of matrices kept '
+      'before it, but the memory budget is {:.1f} MB.'
+      .format(what, needed_bytes / 1024. ** 2, self.held_bytes / 1024. ** 2,
+              self.budget_bytes / 1024. ** 2))
+
+  def hold(self, nbytes, what='A matrix'):
+    """Account for `nbytes` that are kept until the end, e.g. the sum of two
+    distance matrices."""
+    if self.held_bytes + nbytes > self.budget_bytes:
+      self._raise(what, nbytes)
+    self.held_bytes += nbytes
+
+  def check(self, nbytes, what='An op'):
+    """Check that an op needing `nbytes` at its peak, e.g. re-ranking, fits
+    with the matrices kept so far. The peak is not kept."""
+    if self.held_bytes + nbytes > self.budget_bytes:
+      self._raise(what, nbytes)
+
+  def plan(self, num_x, num_y, pair_bytes, out_itemsize, what='A matrix op'):
+    """Plan a matrix op with a [num_x, num_y] result of `out_itemsize` bytes
+    per element, needing `pair_bytes` of working memory per pair of inputs.
+    The result is kept.
+    Returns:
+      x_num_splits, y_num_splits: to pass to `low_memory_matrix_op`
+    """
+    out_bytes = num_x * num_y * out_itemsize
+    free_bytes = self.budget_bytes - self.held_bytes - out_bytes
+    # A single tile is the result itself.
+    if 0 <= num_x * num_y * pair_bytes <= free_bytes:
+      self.held_bytes += out_bytes
+      return 1, 1
+    # Otherwise every tile is also copied into the result.
+    tile_pair_bytes = (pair_bytes + out_itemsize) * self.num_workers
+    if free_bytes < tile_pair_bytes:
+      self._raise(what, out_bytes + tile_pair_bytes)
+    max_tile_pairs = free_bytes // tile_pair_bytes
+    # As square as possible, for the least recomputation of per-row terms.
+    tile_x = int(min(num_x, max(1, np.sqrt(max_tile_pairs))))
+    tile_y = int(min(num_y, max(1, max_tile_pairs // tile_x)))
+    tile_x = int(min(num_x, max(1, max_tile_pairs // tile_y)))
+    self.held_bytes += out_bytes
+    return (int(np.ceil(num_x / float(tile_x))),
+            int(np.ceil(num_y / float(tile_y))))
+
+
+_tile_worker_args = None
+
+
+def _init_tile_worker(func, self_func, x_parts, y_parts):
+  global _tile_worker_args
+  _tile_worker_args = (func, self_func, x_parts, y_parts)
+
+
+def _compute_tile(tile):
+  """Compute tile (i, j) of `low_memory_matrix_op` in a worker process set up
+  by `_init_tile_worker`."""
+  func, self_func, x_parts, y_parts = _tile_worker_args
+  i, j = tile
+  if self_func is not None and i == j:
+    return i, j, self_func(x_parts[i])
+  return i, j, func(x_parts[i], y_parts[j])
+
+
 def low_memory_matrix_op(
     func,
     x, y,
     x_split_axis, y_split_axis,
     x_num_splits, y_num_splits,
-    verbose=False):
+    verbose=False,
+    num_workers=1,
+    backend='thread',
+    self_func=None):
   """
   For matrix operation like multiplication, in order not to flood the memory 
   with huge data, split matrices into smaller parts (Divide and Conquer). 
@@ -155,10 +355,24 @@ def low_memory_matrix_op(
     x_num_splits: number of splits. 1 <= x_num_splits <= M
     y_num_splits: number of splits. 1 <= y_num_splits <= N
     verbose: whether to print the progress
+    num_workers: number of parts computed at the same time
+    backend: 'thread' or 'process', whether parts are computed by a pool of
+      threads or of forked processes, if `num_workers > 1`. Threads suit
+      functions that spend most of their time in numpy, which releases the
+      GIL, e.g. `local_dist`; processes suit the others.
+    self_func: for a symmetric `func` and `y` being `x`, split the same way,
+      a function self_func(x) -> z equal to func(x, x), e.g.
+      `self_local_dist`. Then only the parts on and above the diagonal are
+      computed, those on it by `self_func`, and the others are mirrored.
     
   Returns:
     mat: numpy array, shape [M, N]
   """
+  assert backend in ['thread', 'process']
+  if self_func is not None:
+    assert y is x and y_split_axis == x_split_axis \
+           and y_num_splits == x_num_splits, \
+      "A symmetric op must split `x` and `y`, which is `x`, the same way."
 
   if verbose:
     import sys
@@ -167,13 +381,50 @@ def low_memory_matrix_op(
     st = time.time()
     last_time = time.time()
 
-  mat = [[] for _ in range(x_num_splits)]
-  for i, part_x in enumerate(
-      np.array_split(x, x_num_splits, axis=x_split_axis)):
-    for j, part_y in enumerate(
-        np.array_split(y, y_num_splits, axis=y_split_axis)):
-      part_mat = func(part_x, part_y)
-      mat[i].append(part_mat)
+  x_parts = np.array_split(x, x_num_splits, axis=x_split_axis)
+  y_parts = np.array_split(y, y_num_splits, axis=y_split_axis)
+  x_starts = np.cumsum([0] + [p.shape[x_split_axis] for p in x_parts])
+  y_starts = np.cumsum([0] + [p.shape[y_split_axis] for p in y_parts])
+  tiles = [(i, j) for i in range(x_num_splits) for j in range(y_num_splits)
+           if self_func is None or i <= j]
+
+  def compute(tile):
+    i, j = tile
+    if self_func is not None and i == j:
+      return i, j, self_func(x_parts[i])
+    return i, j, func(x_parts[i], y_parts[j])
+
+  pool = None
+  if num_workers <= 1:
+    results = (compute(tile) for tile in tiles)
+  elif backend == 'thread':
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(num_workers)
+    results = pool.imap_unordered(compute, tiles)
+  else:
+    from multiprocessing import Pool
+    # Forked workers inherit `func` and the parts, only tile indices and
+    # results are pickled.
+    pool = Pool(num_workers, initializer=_init_tile_worker,
+                initargs=(func, self_func, x_parts, y_parts))
+    results = pool.imap_unordered(_compute_tile, tiles)
+
+  # Parts are written into the result as they come, instead of being kept
+  # until the end and concatenated.
+  mat = None
+  try:
+    for num_done, (i, j, part_mat) in enumerate(results, 1):
+      if len(tiles) == 1:
+        # A single part is the result, no need to copy it.
+        mat = part_mat
+      else:
+        if mat is None:
+          mat = np.empty([x_starts[-1], y_starts[-1]], dtype=part_mat.dtype)
+        mat[x_starts[i]:x_starts[i + 1],
+            y_starts[j]:y_starts[j + 1]] = part_mat
+        if self_func is not None and i != j:
+          mat[y_starts[j]:y_starts[j + 1],
+              x_starts[i]:x_starts[i + 1]] = part_mat.T
 
       if verbose:
         if not printed:
@@ -181,10 +432,12 @@ def low_memory_matrix_op(
         else:
           # Clean the current line
           sys.stdout.write("\033[F\033[K")
-        print('Matrix part ({}, {}) / ({}, {}), +{:.2f}s, total {:.2f}s'
-              .format(i + 1, j + 1, x_num_splits, y_num_splits,
+        print('Matrix part {} / {} ({}, {}), +{:.2f}s, total {:.2f}s'
+              .format(num_done, len(tiles), i + 1, j + 1,
                       time.time() - last_time, time.time() - st))
         last_time = time.time()
-    mat[i] = np.concatenate(mat[i], axis=1)
-  mat = np.concatenate(mat, axis=0)
-  return mat
\ No newline at end of file
+  finally:
+    if pool is not None:
+      pool.terminate()
+      pool.join()
+  return mat
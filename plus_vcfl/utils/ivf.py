@@ -0,0 +1,199 @@
+"""An inverted file (IVF) index for approximate nearest neighbour search of
+gallery features by euclidean distance, in numpy. A coarse quantizer, trained
+by k-means, splits the gallery into lists; a query is only compared with the
+samples of the `nprobe` lists whose centroids are nearest to it. Distances to
+those samples are exact, i.e. those of `compute_dist(..., type='euclidean')`,
+and results are `RankList`s, accepted by the metric code."""
+from __future__ import print_function
+import numpy as np
+import scipy.sparse
+
+from .distance import compute_dist
+from .distance import row_sq_norms
+from .distance import euclidean_from_product
+from .retrieval import merge_topk
+from .retrieval import sort_topk
+
+
+def nearest_centroids(x, centroids, chunk_size=4096):
+  """The index of the nearest centroid of each sample.
+  Args:
+    x: numpy array with shape [N, d]
+    centroids: numpy array with shape [num_centroids, d]
+    chunk_size: samples compared at a time, to bound memory
+  Returns:
+    numpy array with shape [N]
+  """
+  assign = np.empty(len(x), dtype=np.int64)
+  for start in range(0, len(x), chunk_size):
+    dist = compute_dist(x[start:start + chunk_size], centroids)
+    assign[start:start + chunk_size] = np.argmin(dist, axis=1)
+  return assign
+
+
+def kmeans(x, num_clusters, num_iters=20, prng=np.random, verbose=False):
+  """Lloyd's k-means, starting from random samples. A cluster that becomes
+  empty is restarted from a random sample.
+  Args:
+    x: numpy array with shape [N, d], N >= num_clusters
+    num_clusters: a scalar
+    num_iters: a scalar
+    prng: a numpy random state or `np.random`
+    verbose: whether to print the progress
+  Returns:
+    centroids: float32 numpy array with shape [num_clusters, d]
+  """
+  x = np.asarray(x, dtype=np.float32)
+  assert len(x) >= num_clusters, \
+    '{} samples can not train {} clusters'.format(len(x), num_clusters)
+  centroids = x[prng.choice(len(x), num_clusters, replace=False)]
+  for it in range(num_iters):
+    assign = nearest_centroids(x, centroids)
+    counts = np.bincount(assign, minlength=num_clusters)
+    # Sum the samples of each cluster by a sparse [num_clusters, N] product.
+    members = scipy.sparse.csr_matrix(
+      (np.ones(len(x), dtype=np.float32), (assign, np.arange(len(x)))),
+      shape=(num_clusters, len(x)))
+    sums = members.dot(x)
+    empty = counts == 0
+    centroids = sums / np.maximum(counts, 1)[:, np.newaxis]
+    centroids[empty] = x[prng.choice(len(x), int(np.sum(empty)), replace=False)]
+    centroids = centroids.astype(np.float32)
+    if verbose:
+      print('K-means iteration {} / {}, {} empty clusters restarted'
+            .format(it + 1, num_iters, int(np.sum(empty))))
+  return centroids
+
+
+class IVFIndex(object):
+  """An inverted file index. Samples added to it are kept in float32, ordered
+  by list, with their squared norms.
+
+  Usage:
+    index = IVFIndex(num_lists=1024, nprobe=16)
+    index.train(gallery_feats)
+    index.add(gallery_feats)
+    rank_list = index.search(query_feats, k=100)
+  """
+
+  def __init__(self, num_lists, nprobe=8):
+    """
+    Args:
+      num_lists: the number of lists, i.e. of centroids of the quantizer; a
+        few times sqrt(num_gallery) is a good start
+      nprobe: the number of lists searched per query by default; more is
+        slower and more accurate
+    """
+    self.num_lists = num_lists
+    self.nprobe = nprobe
+    self.centroids = None
+    # Gallery indices and features of the samples, ordered by list
+    self.ids = np.empty([0], dtype=np.int64)
+    self.vecs = None
+    self.sq_norms = None
+    # Samples of list l are at [list_starts[l], list_starts[l + 1])
+    self.list_starts = np.zeros([num_lists + 1], dtype=np.int64)
+
+  @property
+  def ntotal(self):
+    return len(self.ids)
+
+  def train(self, x, num_iters=20, max_train_samples=None, prng=np.random,
+            verbose=False):
+    """Train the coarse quantizer with k-means on `x`, or on a random subset
+    of `max_train_samples` of it, by default 256 per list."""
+    if max_train_samples is None:
+      max_train_samples = 256 * self.num_lists
+    if len(x) > max_train_samples:
+      x = x[np.sort(prng.choice(len(x), max_train_samples, replace=False))]
+    self.centroids = kmeans(
+      x, self.num_lists, num_iters=num_iters, prng=prng, verbose=verbose)
+
+  def add(self, x):
+    """Add samples, whose gallery indices continue from `ntotal`.
+    Args:
+      x: numpy array with shape [N, d]
+    """
+    assert self.centroids is not None, 'The index has to be trained first'
+    x = np.asarray(x, dtype=np.float32)
+    assign = nearest_centroids(x, self.centroids)
+    ids = np.arange(self.ntotal, self.ntotal + len(x))
+    if self.vecs is not None:
+      old_assign = np.repeat(np.arange(self.num_lists),
+                             np.diff(self.list_starts))
+      assign = np.concatenate([old_assign, assign])
+      ids = np.concatenate([self.ids, ids])
+      x = np.concatenate([self.vecs, x])
+    order = np.argsort(assign, kind='mergesort')
+    self.ids = ids[order]
+    self.vecs = x[order]
+    self.sq_norms = row_sq_norms(self.vecs)
+    self.list_starts = np.searchsorted(
+      assign[order], np.arange(self.num_lists + 1))
+
+  def probe(self, query, k, nprobe):
+    """Which lists each query searches: the `nprobe` lists with the nearest
+    centroids, and more if they hold less than `k` samples.
+    Returns:
+      numpy array of bools with shape [num_query, num_lists]
+    """
+    list_order = np.argsort(compute_dist(query, self.centroids), axis=1)
+    list_sizes = np.diff(self.list_starts)
+    covered = np.cumsum(list_sizes[list_order], axis=1)
+    num_probed = np.maximum(nprobe, np.argmax(covered >= k, axis=1) + 1)
+    probed = np.zeros([len(query), self.num_lists], dtype=np.bool)
+    rows = np.arange(len(query))[:, np.newaxis]
+    probed[rows, list_order] = \
+      np.arange(self.num_lists) < num_probed[:, np.newaxis]
+    return probed
+
+  def search(self, query, k, nprobe=None):
+    """Search the top `k` samples of each query. Queries are grouped by the
+    lists they probe, so that each list is compared with all its queries at
+    once.
+    Args:
+      query: numpy array with shape [num_query, d]
+      k: a scalar
+      nprobe: the number of lists to search, `self.nprobe` if `None`
+    Returns:
+      a `RankList`, whose distances are the exact euclidean distances
+    """
+    assert self.ntotal > 0, 'The index is empty'
+    nprobe = self.nprobe if nprobe is None else nprobe
+    k = min(k, self.ntotal)
+    query = np.asarray(query, dtype=np.float32)
+    num_query = len(query)
+    q_sq_norms = row_sq_norms(query)
+    probed = self.probe(query, k, nprobe)
+    indices = np.full([num_query, k], -1, dtype=np.int64)
+    dists = np.full([num_query, k], np.inf, dtype=np.float32)
+    for l in np.nonzero(np.any(probed, axis=0))[0]:
+      start, stop = self.list_starts[l], self.list_starts[l + 1]
+      if start == stop:
+        continue
+      sub = np.nonzero(probed[:, l])[0]
+      # The same as `compute_dist`, with the norms computed once.
+      block_dists = euclidean_from_product(
+        np.matmul(query[sub], self.vecs[start:stop].T),
+        q_sq_norms[sub][:, np.newaxis],
+        self.sq_norms[np.newaxis, start:stop])
+      indices[sub], dists[sub] = merge_topk(
+        indices[sub], dists[sub], self.ids[start:stop], block_dists, k)
+    return sort_topk(indices, dists, self.ntotal)
+
+  def save(self, path):
+    """Save the index to a `.npz` file."""
+    np.savez(path, num_lists=self.num_lists, nprobe=self.nprobe,
+             centroids=self.centroids, ids=self.ids, vecs=self.vecs,
+             list_starts=self.list_starts)
+
+  @classmethod
+  def load(cls, path):
+    data = np.load(path)
+    index = cls(int(data['num_lists']), nprobe=int(data['nprobe']))
+    index.centroids = data['centroids']
+    index.ids = data['ids']
+    index.vecs = data['vecs']
+    index.sq_norms = row_sq_norms(index.vecs)
+    index.list_starts = data['list_starts']
+    return index
@@ -9,7 +9,8 @@ from __future__ import absolute_import
 from collections import defaultdict
 
 import numpy as np
-from sklearn.metrics import average_precision_score
+
+from .retrieval import RankList
 
 
 def _unique_sample(ids_dict, num):
@@ -20,6 +21,108 @@ def _unique_sample(ids_dict, num):
   return mask
 
 
+class _GalleryCounts(object):
+  """The number of gallery samples of each id and of each (id, camera), to
+  count the matches of queries in the whole gallery when only their rank
+  lists are known."""
+
+  def __init__(self, gallery_ids, gallery_cams):
+    ids, counts = np.unique(gallery_ids, return_counts=True)
+    self.id_counts = dict(zip(ids.tolist(), counts.tolist()))
+    id_cams, counts = np.unique(
+      np.stack([gallery_ids, gallery_cams], axis=1), axis=0, return_counts=True)
+    self.id_cam_counts = dict(zip(map(tuple, id_cams.tolist()),
+                                  counts.tolist()))
+
+  def num_valid(self, g_id, q_id, q_cam, separate_camera_set):
+    """The number of gallery samples of id `g_id` that are not filtered out
+    for a query (`q_id`, `q_cam`)."""
+    num = self.id_counts.get(g_id, 0)
+    if g_id == q_id or separate_camera_set:
+      num -= self.id_cam_counts.get((g_id, q_cam), 0)
+    return num
+
+
+def _rank_list_cmc(
+    rank_list,
+    query_ids,
+    gallery_ids,
+    query_cams,
+    gallery_cams,
+    topk,
+    separate_camera_set,
+    single_gallery_shot,
+    first_match_break,
+    average):
+  """`cmc` of a `RankList`. Matches beyond the rank list are ranked beyond
+  `topk`. Without `single_gallery_shot`, this is the same as `cmc` of the
+  dense distance matrix, as long as each rank list holds `topk` valid
+  samples that do not match. With `single_gallery_shot`, the randomly chosen
+  instance of the query id may lie beyond the rank list, so scores are only
+  exact if the rank lists hold the whole gallery, and lower otherwise."""
+  indices = rank_list.indices
+  m = indices.shape[0]
+  counts = _GalleryCounts(gallery_ids, gallery_cams)
+  matches = (gallery_ids[indices] == query_ids[:, np.newaxis])
+  ret = np.zeros([m, topk])
+  is_valid_query = np.zeros(m)
+  num_valid_queries = 0
+  for i in range(m):
+    q_id, q_cam = query_ids[i], query_cams[i]
+    # Filter out the same id and same camera
+    valid = ((gallery_ids[indices[i]] != q_id) |
+             (gallery_cams[indices[i]] != q_cam))
+    if separate_camera_set:
+      # Filter out samples from same camera
+      valid &= (gallery_cams[indices[i]] != q_cam)
+    # Matches are counted in the whole gallery, not only in the rank list.
+    num_matches = counts.num_valid(q_id, q_id, q_cam, separate_camera_set)
+    if num_matches == 0: continue
+    is_valid_query[i] = 1
+    if single_gallery_shot:
+      repeat = 100
+      inds = np.where(valid)[0]
+      # The ids in the rank list, and the number of samples of each, in the
+      # whole gallery, one of which is chosen
+      uniq_ids, id_inds = np.unique(
+        gallery_ids[indices[i][inds]], return_inverse=True)
+      num_choices = np.array([counts.num_valid(
+        g_id, q_id, q_cam, separate_camera_set) for g_id in uniq_ids.tolist()])
+      # The order of each sample among the samples of its id in the list
+      order = np.argsort(id_inds, kind='mergesort')
+      id_starts = np.searchsorted(id_inds[order], np.arange(len(uniq_ids)))
+      rank_in_id = np.empty(len(inds), dtype=np.int64)
+      rank_in_id[order] = np.arange(len(inds)) - id_starts[id_inds[order]]
+    else:
+      repeat = 1
+    for _ in range(repeat):
+      if single_gallery_shot:
+        # Randomly choose one instance for each id. An instance beyond the
+        # rank list is chosen if the choice exceeds the samples in the list.
+        choices = (np.random.rand(len(uniq_ids)) * num_choices).astype(np.int64)
+        sampled = np.zeros(len(valid), dtype=np.bool)
+        sampled[inds[rank_in_id == choices[id_inds]]] = True
+        index = np.nonzero(matches[i, sampled])[0]
+        # Exactly one instance of the query id is chosen.
+        delta = 1. / repeat
+      else:
+        index = np.nonzero(matches[i, valid])[0]
+        delta = 1. / (num_matches * repeat)
+      for j, k in enumerate(index):
+        if k - j >= topk: break
+        if first_match_break:
+          ret[i, k - j] += 1
+          break
+        ret[i, k - j] += delta
+    num_valid_queries += 1
+  if num_valid_queries == 0:
+    raise RuntimeError("No valid query")
+  ret = ret.cumsum(axis=1)
+  if average:
+    return np.sum(ret, axis=0) / num_valid_queries
+  return ret, is_valid_query
+
+
 def cmc(
     distmat,
     query_ids=None,
@@ -34,7 +137,7 @@ def cmc(
   """
   Args:
     distmat: numpy array with shape [num_query, num_gallery], the 
-      pairwise distance between query and gallery samples
+      pairwise distance between query and gallery samples, or a `RankList`
     query_ids: numpy array with shape [num_query]
     gallery_ids: numpy array with shape [num_gallery]
     query_cams: numpy array with shape [num_query]
@@ -49,12 +152,17 @@ def cmc(
       numpy array with shape [topk]
   """
   # Ensure numpy array
-  assert isinstance(distmat, np.ndarray)
+  assert isinstance(distmat, (np.ndarray, RankList))
   assert isinstance(query_ids, np.ndarray)
   assert isinstance(gallery_ids, np.ndarray)
   assert isinstance(query_cams, np.ndarray)
   assert isinstance(gallery_cams, np.ndarray)
 
+  if isinstance(distmat, RankList):
+    return _rank_list_cmc(
+      distmat, query_ids, gallery_ids, query_cams, gallery_cams, topk,
+      separate_camera_set, single_gallery_shot, first_match_break, average)
+
   m, n = distmat.shape
   # Sort and find correct matches
   indices = np.argsort(distmat, axis=1)
@@ -104,6 +212,69 @@ def cmc(
   return ret, is_valid_query
 
 
+def _average_precision(matches, dists, num_matches):
+  """The average precision of one query, as `average_precision_score` of
+  scikit-learn 0.18.1 computes it, which has the same results as the Matlab
+  evaluation code by Zhun Zhong
+  (https://github.com/zhunzhong07/person-re-ranking/
+  blob/master/evaluation/utils/evaluation.m) and by Liang Zheng
+  (http://www.liangzheng.org/Project/project_reid.html): the area under the
+  precision-recall curve by the trapezoidal rule, starting from recall 0 and
+  precision 1, with a point after each group of equal distances.
+  Args:
+    matches: numpy array of bools, whether the valid gallery samples, sorted
+      by ascending distance, match the query
+    dists: numpy array, the distances of these samples
+    num_matches: the number of matches among all valid gallery samples,
+      which is more than `matches` holds if the samples are cut short
+  Returns:
+    a scalar
+  """
+  if len(matches) == 0:
+    return 0.
+  # The last sample of each group of equal distances
+  ends = np.append(np.nonzero(np.diff(dists))[0], len(dists) - 1)
+  tps = np.cumsum(matches)[ends]
+  precision = np.append(1., tps / (ends + 1.))
+  recall = np.append(0., tps / float(num_matches))
+  return np.sum(np.diff(recall) * (precision[1:] + precision[:-1]) / 2.)
+
+
+def _rank_list_mean_ap(
+    rank_list,
+    query_ids,
+    gallery_ids,
+    query_cams,
+    gallery_cams,
+    average):
+  """`mean_ap` of a `RankList`, by the same `_average_precision` as of
+  distance matrices. Matches beyond the rank list add zero, so this is the
+  same as `mean_ap` of the dense distance matrix if the rank lists hold all
+  matches and the samples tied with the last of them, and a lower bound
+  otherwise."""
+  indices = rank_list.indices
+  m = indices.shape[0]
+  counts = _GalleryCounts(gallery_ids, gallery_cams)
+  matches = (gallery_ids[indices] == query_ids[:, np.newaxis])
+  aps = np.zeros(m)
+  is_valid_query = np.zeros(m)
+  for i in range(m):
+    # Filter out the same id and same camera
+    valid = ((gallery_ids[indices[i]] != query_ids[i]) |
+             (gallery_cams[indices[i]] != query_cams[i]))
+    num_matches = counts.num_valid(
+      query_ids[i], query_ids[i], query_cams[i], False)
+    if num_matches == 0: continue
+    is_valid_query[i] = 1
+    aps[i] = _average_precision(
+      matches[i, valid], rank_list.dists[i, valid], num_matches)
+  if len(aps) == 0:
+    raise RuntimeError("No valid query")
+  if average:
+    return float(np.sum(aps)) / np.sum(is_valid_query)
+  return aps, is_valid_query
+
+
 def mean_ap(
     distmat,
     query_ids=None,
@@ -114,7 +285,7 @@ def mean_ap(
   """
   Args:
     distmat: numpy array with shape [num_query, num_gallery], the 
-      pairwise distance between query and gallery samples
+      pairwise distance between query and gallery samples, or a `RankList`
     query_ids: numpy array with shape [num_query]
     gallery_ids: numpy array with shape [num_gallery]
     query_cams: numpy array with shape [num_query]
@@ -129,25 +300,12 @@ def mean_ap(
       a scalar
   """
 
-  # -------------------------------------------------------------------------
-  # The behavior of method `sklearn.average_precision` has changed since version
-  # 0.19.
-  # Version 0.18.1 has same results as Matlab evaluation code by Zhun Zhong
-  # (https://github.com/zhunzhong07/person-re-ranking/
-  # blob/master/evaluation/utils/evaluation.m) and by Liang Zheng
-  # (http://www.liangzheng.org/Project/project_reid.html).
-  # My current awkward solution is sticking to this older version.
-  import sklearn
-  cur_version = sklearn.__version__
-  required_version = '0.18.1'
-  if cur_version != required_version:
-    print('User Warning: Version {} is required for package scikit-learn, '
-          'your current version is {}. '
-          'As a result, the mAP score may not be totally correct. '
-          'You can try `pip uninstall scikit-learn` '
-          'and then `pip install scikit-learn=={}`'.format(
-      required_version, cur_version, required_version))
-  # -------------------------------------------------------------------------
+  # The AP of scikit-learn 0.18.1, which changed in 0.19, is computed by
+  # `_average_precision` for both distance matrices and rank lists, whatever
+  # version of scikit-learn is installed.
+  if isinstance(distmat, RankList):
+    return _rank_list_mean_ap(
+      distmat, query_ids, gallery_ids, query_cams, gallery_cams, average)
 
   # Ensure numpy array
   assert isinstance(distmat, np.ndarray)
@@ -169,10 +327,10 @@ def mean_ap(
     valid = ((gallery_ids[indices[i]] != query_ids[i]) |
              (gallery_cams[indices[i]] != query_cams[i]))
     y_true = matches[i, valid]
-    y_score = -distmat[i][indices[i]][valid]
     if not np.any(y_true): continue
     is_valid_query[i] = 1
-    aps[i] = average_precision_score(y_true, y_score)
+    aps[i] = _average_precision(
+      y_true, distmat[i][indices[i]][valid], np.sum(y_true))
   if len(aps) == 0:
     raise RuntimeError("No valid query")
   if average:
@@ -32,6 +32,15 @@ Returns:
 import numpy as np
 
 
+def re_ranking_bytes(num_query, num_gallery):
+    """An upper bound of the memory `re_ranking` allocates at its peak, besides
+    its inputs: for N = num_query + num_gallery, the [N, N] float32 distance,
+    `V` and int32 rank matrices, and the int64 result of `argsort`, which
+    take 20 bytes per element, plus a margin for per-row temporaries."""
+    num_all = num_query + num_gallery
+    return 22 * num_all ** 2
+
+
 def re_ranking(q_g_dist, q_q_dist, g_g_dist, k1=20, k2=6, lambda_value=0.3):
 
     # The following naming, e.g. gallery_num, is different from outer scope.
@@ -0,0 +1,118 @@
+"""Retrieval of the top-k gallery samples of each query, streaming the gallery
+block by block, so that the [num_query, num_gallery] distance matrix is never
+held in memory. The result, a `RankList`, is accepted by `metric.cmc`,
+`metric.mean_ap` and `visualization.get_rank_list` in place of a distance
+matrix."""
+from __future__ import print_function
+import numpy as np
+
+
+class RankList(object):
+  """The top-k gallery samples of each query, sorted by ascending distance,
+  ties broken by gallery index.
+  Attributes:
+    indices: numpy array with shape [num_query, k], gallery indices
+    dists: numpy array with shape [num_query, k], the distances
+    num_gallery: the number of gallery samples ranked
+  """
+
+  def __init__(self, indices, dists, num_gallery):
+    assert indices.shape == dists.shape
+    self.indices = indices
+    self.dists = dists
+    self.num_gallery = num_gallery
+
+  @property
+  def shape(self):
+    """The shape of the dense distance matrix this list is taken from."""
+    return self.indices.shape[0], self.num_gallery
+
+  @property
+  def k(self):
+    return self.indices.shape[1]
+
+
+def merge_topk(indices, dists, block_indices, block_dists, k):
+  """Merge the running top-k of each query with the distances to a block of
+  gallery samples, keeping the k smallest, unsorted.
+  Args:
+    indices, dists: numpy arrays with shape [num_query, k0], k0 <= k
+    block_indices: numpy array with shape [num_block], gallery indices of the
+      block
+    block_dists: numpy array with shape [num_query, num_block]
+    k: a scalar
+  Returns:
+    indices, dists: numpy arrays with shape [num_query, min(k, k0 + num_block)]
+  """
+  num_query = block_dists.shape[0]
+  indices = np.concatenate(
+    [indices, np.broadcast_to(block_indices, block_dists.shape)], axis=1)
+  dists = np.concatenate([dists, block_dists], axis=1)
+  if dists.shape[1] <= k:
+    return indices, dists
+  keep = np.argpartition(dists, k - 1, axis=1)[:, :k]
+  rows = np.arange(num_query)[:, np.newaxis]
+  return indices[rows, keep], dists[rows, keep]
+
+
+def sort_topk(indices, dists, num_gallery):
+  """Sort the merged top-k of each query into a `RankList`."""
+  # The last key is the primary one.
+  order = np.lexsort((indices, dists))
+  rows = np.arange(indices.shape[0])[:, np.newaxis]
+  return RankList(indices[rows, order], dists[rows, order], num_gallery)
+
+
+def topk_rank_list(dist_func, query, gallery, k, block_size=4096,
+                   verbose=False):
+  """Rank the gallery for each query, keeping the top `k`. The gallery is
+  processed in blocks, so memory is O(num_query * (k + block_size)).
+  Args:
+    dist_func: a function dist_func(query, gallery_block) -> numpy array with
+      shape [num_query, num_block], e.g. `distance.compute_dist`
+    query: numpy array, with num_query samples along the first axis
+    gallery: numpy array, with num_gallery samples along the first axis; may
+      be memory mapped, only a block is read at a time
+    k: the number of gallery samples to keep for each query
+    block_size: the number of gallery samples per block
+    verbose: whether to print the progress
+  Returns:
+    a `RankList`
+  """
+  num_query, num_gallery = len(query), len(gallery)
+  assert k >= 1 and block_size >= 1 and num_gallery >= 1
+  k = min(k, num_gallery)
+  indices = np.empty([num_query, 0], dtype=np.int64)
+  dists = None
+  if verbose:
+    import sys
+    import time
+    printed = False
+    st = time.time()
+  num_blocks = int(np.ceil(num_gallery / float(block_size)))
+  for b, start in enumerate(range(0, num_gallery, block_size), 1):
+    stop = min(start + block_size, num_gallery)
+    block_dists = dist_func(query, gallery[start:stop])
+    if dists is None:
+      dists = np.empty([num_query, 0], dtype=block_dists.dtype)
+    indices, dists = merge_topk(
+      indices, dists, np.arange(start, stop), block_dists, k)
+
+    if verbose:
+      if not printed:
+        printed = True
+      else:
+        # Clean the current line
+        sys.stdout.write("\033[F\033[K")
+      print('Gallery block {} / {}, total {:.2f}s'
+            .format(b, num_blocks, time.time() - st))
+  return sort_topk(indices, dists, num_gallery)
+
+
+def dense_rank_list(dist_mat, k):
+  """The `RankList` of a dense [num_query, num_gallery] distance matrix, e.g.
+  a re-ranked one."""
+  k = min(k, dist_mat.shape[1])
+  keep = np.argpartition(dist_mat, k - 1, axis=1)[:, :k]
+  rows = np.arange(dist_mat.shape[0])[:, np.newaxis]
+  return sort_topk(keep, dist_mat[rows, keep], dist_mat.shape[1])
@@ -322,6 +322,16 @@ def may_set_mode(maybe_modules, mode):
         m.eval()
 
 
+def available_memory_bytes():
+  """The memory that can be allocated without swapping, as estimated by the
+  kernel (Linux only)."""
+  with open('/proc/meminfo') as f:
+    for line in f:
+      if line.startswith('MemAvailable:'):
+        return int(line.split()[1]) * 1024
+  return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
 def may_make_dir(path):
   """
   Args:
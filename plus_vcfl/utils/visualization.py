@@ -59,22 +59,29 @@ def make_im_grid(ims, n_rows, n_cols, space, pad_val):
   return ret_im
 
 
-def get_rank_list(dist_vec, q_id, q_cam, g_ids, g_cams, rank_list_size):
+def get_rank_list(dist_vec, q_id, q_cam, g_ids, g_cams, rank_list_size,
+                  sorted_inds=None):
   """Get the ranking list of a query image
   Args:
     dist_vec: a numpy array with shape [num_gallery_images], the distance
-      between the query image and all gallery images
+      between the query image and all gallery images; not used if
+      `sorted_inds` is given
     q_id: a scalar, query id
     q_cam: a scalar, query camera
     g_ids: a numpy array with shape [num_gallery_images], gallery ids
     g_cams: a numpy array with shape [num_gallery_images], gallery cameras
     rank_list_size: a scalar, the number of images to show in a rank list
+    sorted_inds: (Optionally) gallery indices already sorted by distance, e.g.
+      `indices[i]` of a `retrieval.RankList` for query i
   Returns:
     rank_list: a list, the indices of gallery images to show
     same_id: a list, len(same_id) = rank_list, whether each ranked image is
       with same id as query
   """
-  sort_inds = np.argsort(dist_vec)
+  if sorted_inds is None:
+    sort_inds = np.argsort(dist_vec)
+  else:
+    sort_inds = np.asarray(sorted_inds)
   rank_list = []
   same_id = []
   i = 0
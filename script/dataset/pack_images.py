@@ -0,0 +1,36 @@
+"""Pack the images of a dataset, decoded and resized, into a single uint8
+`.npy` file next to its `partitions.pkl`. Training and testing can then read
+images through memory mapping with `create_dataset(..., use_im_store=True)`.
+"""
+from __future__ import print_function
+
+import sys
+sys.path.insert(0, '.')
+
+import argparse
+
+from plus_vcfl.dataset import get_dataset_paths
+from plus_vcfl.dataset.ImageStore import build_im_store
+from plus_vcfl.dataset.ImageStore import get_im_store_file
+from plus_vcfl.utils.utils import measure_time
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Pack Dataset Images")
+  parser.add_argument('--dataset', type=str, default='market1501',
+                      choices=['market1501', 'cuhk03', 'duke', 'combined'])
+  parser.add_argument('--resize_h_w', type=eval, default=(256, 128))
+  parser.add_argument('--store_file', type=str, default='')
+  args = parser.parse_args()
+
+  im_dir, partition_file = get_dataset_paths(args.dataset)
+  store_file = args.store_file
+  if store_file == '':
+    store_file = get_im_store_file(partition_file, args.resize_h_w)
+  with measure_time('Packing images of {} into {}...'
+                        .format(args.dataset, store_file)):
+    build_im_store(im_dir, partition_file, store_file, args.resize_h_w)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,101 @@
+"""Report the recall and latency of searching the gallery with an `IVFIndex`,
+against exact search, on test set features saved by `FeatCache`, i.e. an
+entry directory under `--feat_cache_dir` of a test run of the training
+scripts, holding `global_feat.npy`, `marks.npy`, `ids.npy` and `cams.npy`.
+
+Example:
+  python script/experiment/ivf_report.py \
+    --feat_dirs "('feat_cache/<market1501 key>', 'feat_cache/<duke key>')" \
+    --names "('market1501', 'duke')"
+"""
+from __future__ import print_function
+
+import sys
+sys.path.insert(0, '.')
+
+import time
+import argparse
+import os.path as osp
+import numpy as np
+
+from plus_vcfl.utils.ivf import IVFIndex
+from plus_vcfl.utils.retrieval import topk_rank_list
+from plus_vcfl.utils.distance import compute_dist
+from plus_vcfl.utils.metric import mean_ap, cmc
+
+
+def recall_at(rank_list, exact_rank_list, k):
+  """The fraction of the exact top k found in the approximate top k."""
+  found = [len(np.intersect1d(a[:k], b[:k])) for a, b in
+           zip(rank_list.indices, exact_rank_list.indices)]
+  return np.mean(found) / float(k)
+
+
+def report(feat_dir, name, num_lists, nprobes, k, num_runs, seed):
+  load = lambda n: np.load(osp.join(feat_dir, '{}.npy'.format(n)))
+  feats, marks = load('global_feat'), load('marks')
+  ids, cams = load('ids'), load('cams')
+  q_inds, g_inds = marks == 0, marks == 1
+  q_feats, g_feats = feats[q_inds], feats[g_inds]
+  num_q, num_g = len(q_feats), len(g_feats)
+  if num_lists is None:
+    num_lists = int(4 * np.sqrt(num_g))
+  score_kwargs = dict(query_ids=ids[q_inds], gallery_ids=ids[g_inds],
+                      query_cams=cams[q_inds], gallery_cams=cams[g_inds])
+
+  def timed(search):
+    """The result of `search`, and the best time of `num_runs` runs, in ms
+    per query."""
+    times = []
+    for _ in range(num_runs):
+      st = time.time()
+      rank_list = search()
+      times.append(time.time() - st)
+    return rank_list, 1000. * min(times) / num_q
+
+  def print_row(method, rank_list, ms):
+    print('{:<14} {:>10.4f} {:>10.4f} {:>8.2%} {:>8.2%} {:>12.3f}'.format(
+      method, recall_at(rank_list, exact, 1), recall_at(rank_list, exact, k),
+      mean_ap(rank_list, **score_kwargs),
+      cmc(rank_list, topk=1, first_match_break=True, **score_kwargs)[0], ms))
+
+  print('\n=========> {}: {} queries, {} gallery, {}-d <========='
+        .format(name, num_q, num_g, feats.shape[1]))
+  exact, exact_ms = timed(
+    lambda: topk_rank_list(compute_dist, q_feats, g_feats, k))
+  st = time.time()
+  index = IVFIndex(num_lists)
+  index.train(g_feats, prng=np.random.RandomState(seed))
+  index.add(g_feats)
+  print('IVF index of {} lists built in {:.2f}s'
+        .format(num_lists, time.time() - st))
+  print('{:<14} {:>10} {:>10} {:>8} {:>8} {:>12}'.format(
+    'search', 'recall@1', 'recall@{}'.format(k), 'mAP@{}'.format(k),
+    'rank-1', 'ms / query'))
+  print_row('exact', exact, exact_ms)
+  for nprobe in nprobes:
+    rank_list, ms = timed(lambda: index.search(q_feats, k, nprobe=nprobe))
+    print_row('nprobe={}'.format(nprobe), rank_list, ms)
+
+
+def main():
+  parser = argparse.ArgumentParser(description="IVF Recall/Latency Report")
+  parser.add_argument('--feat_dirs', type=eval, required=True)
+  parser.add_argument('--names', type=eval, default=None)
+  parser.add_argument('--num_lists', type=int, default=None)
+  parser.add_argument('--nprobes', type=eval, default=(1, 2, 4, 8, 16, 32))
+  parser.add_argument('-k', type=int, default=100)
+  parser.add_argument('--num_runs', type=int, default=3)
+  parser.add_argument('--seed', type=int, default=1)
+  args = parser.parse_args()
+
+  names = args.names
+  if names is None:
+    names = [osp.basename(osp.normpath(d)) for d in args.feat_dirs]
+  for feat_dir, name in zip(args.feat_dirs, names):
+    report(feat_dir, name, args.num_lists, args.nprobes, args.k,
+           args.num_runs, args.seed)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,90 @@
+"""Measure the images per second that `TrainSet.next_batch` delivers with
+the thread and process prefetching backends, for a number of workers.
+Nothing else runs in the loop, so this is the upper bound the data pipeline
+puts on training speed. Run it from the repo root, on the machine whose
+cores are to be measured; more workers than cores only adds contention.
+
+Example:
+  python script/experiment/prefetch_benchmark.py --dataset market1501 \
+    --num_workers "(1, 2, 4, 8, 16)" --backends "('thread', 'process')"
+"""
+from __future__ import print_function
+
+import sys
+sys.path.insert(0, '.')
+
+import time
+import argparse
+import multiprocessing
+
+from plus_vcfl.dataset import create_dataset
+
+
+def measure(args, backend, num_workers):
+  """Images per second over `args.num_epochs` epochs, after one warm-up
+  epoch, which forks the workers and fills their image caches."""
+  train_set = create_dataset(
+    name=args.dataset,
+    part='trainval',
+    ids_per_batch=args.ids_per_batch,
+    ims_per_id=args.ims_per_id,
+    final_batch=False,
+    resize_h_w=args.resize_h_w,
+    scale=True,
+    im_mean=[0.486, 0.459, 0.408],
+    im_std=[0.229, 0.224, 0.225],
+    mirror_type='random',
+    batch_dims='NCHW',
+    crop_prob=args.crop_prob,
+    crop_ratio=args.crop_ratio,
+    num_prefetch_threads=num_workers,
+    prefetch_backend=backend,
+    im_cache_bytes=args.im_cache_mb * 1024 ** 2,
+    overlap_epochs=True,
+    seed=args.seed)
+  num_ims = 0
+  for ep in range(args.num_epochs + 1):
+    if ep == 1:
+      st = time.time()
+      num_ims = 0
+    done = False
+    while not done:
+      ims, _, _, _, _, done = train_set.next_batch()
+      num_ims += len(ims)
+  elapsed = time.time() - st
+  train_set.stop_prefetching_threads()
+  return num_ims / elapsed
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Prefetching Benchmark")
+  parser.add_argument('-d', '--dataset', type=str, default='market1501',
+                      choices=['market1501', 'cuhk03', 'duke', 'combined'])
+  parser.add_argument('--backends', type=eval, default=('thread', 'process'))
+  parser.add_argument('--num_workers', type=eval, default=(1, 2, 4, 8, 16))
+  parser.add_argument('--num_epochs', type=int, default=2)
+  parser.add_argument('--ids_per_batch', type=int, default=32)
+  parser.add_argument('--ims_per_id', type=int, default=4)
+  parser.add_argument('--resize_h_w', type=eval, default=(256, 128))
+  parser.add_argument('--crop_prob', type=float, default=0.5)
+  parser.add_argument('--crop_ratio', type=float, default=0.9)
+  parser.add_argument('--im_cache_mb', type=int, default=0)
+  parser.add_argument('--seed', type=int, default=1)
+  args = parser.parse_args()
+
+  results = []
+  for backend in args.backends:
+    for num_workers in args.num_workers:
+      results.append(
+        (backend, num_workers, measure(args, backend, num_workers)))
+
+  print('\n=========> {}, {} cores, {} images/id, {}MB image cache <========='
+        .format(args.dataset, multiprocessing.cpu_count(), args.ims_per_id,
+                args.im_cache_mb))
+  print('{:<10} {:>8} {:>12}'.format('backend', 'workers', 'images / s'))
+  for backend, num_workers, ims_per_sec in results:
+    print('{:<10} {:>8} {:>12.1f}'.format(backend, num_workers, ims_per_sec))
+
+
+if __name__ == '__main__':
+  main()
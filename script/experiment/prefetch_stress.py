@@ -0,0 +1,152 @@
+"""Stress test the prefetcher's reconfiguration: reconfigure it thousands of
+times, by `set_batch_size`, `set_dataset_size` and `stop` followed by a new
+prefetcher, at random points, mid-epoch or between epochs, with both
+backends. Every epoch that is consumed to its end is checked to be complete
+(each sample exactly once), unmixed (only samples of that epoch and of the
+current dataset size) and, when `ordered`, in order. Any failure raises an
+`AssertionError`; a deadlock shows as a run that never ends.
+
+Example:
+  python script/experiment/prefetch_stress.py --num_reconfigs 3000
+"""
+from __future__ import print_function
+
+import sys
+sys.path.insert(0, '.')
+
+import time
+import argparse
+import numpy as np
+
+from plus_vcfl.dataset.Prefetcher import Prefetcher
+
+
+class StressSamples(object):
+  """The samples of the stressed prefetcher. A sample records the epoch and
+  pointer it was produced for, and the dataset size at that time, and
+  carries an array, so that the process backend passes it through shared
+  memory. Now and then a sample is slow, so that workers finish out of
+  order."""
+
+  def __init__(self, dataset_size, slow_prob):
+    self.dataset_size = dataset_size
+    self.slow_prob = slow_prob
+
+  def __call__(self, ptr, epoch):
+    if np.random.uniform() < self.slow_prob:
+      time.sleep(0.001)
+    return epoch, ptr, self.dataset_size, np.full([64], ptr, dtype=np.int64)
+
+
+def check_epoch(samples, epoch, dataset_size, full_dataset_size, ordered):
+  """Check the samples of an epoch consumed to its end. `dataset_size` is
+  less than `full_dataset_size` when the final incomplete batch is
+  dropped."""
+  assert all(s[0] == epoch for s in samples), \
+    'Epoch {} is mixed with epochs {}'.format(
+      epoch, sorted(set(s[0] for s in samples) - {epoch}))
+  assert all(s[2] == full_dataset_size for s in samples), \
+    'Epoch {} is mixed with samples of another dataset size'.format(epoch)
+  assert all(np.all(s[3] == s[1]) for s in samples), \
+    'Epoch {} has corrupted sample arrays'.format(epoch)
+  ptrs = [s[1] for s in samples]
+  assert sorted(ptrs) == list(range(dataset_size)), \
+    'Epoch {} is incomplete or has duplicates: {} samples of {}'.format(
+      epoch, len(ptrs), dataset_size)
+  if ordered:
+    assert ptrs == list(range(dataset_size)), \
+      'Epoch {} is out of order'.format(epoch)
+
+
+def stress(backend, args, prng):
+  """Returns a dict of counts and timings."""
+  timings = dict(set_batch_size=[], set_dataset_size=[], stop=[])
+  num_epochs = 0
+  prefetcher = None
+  for i in range(args.num_reconfigs):
+    if prefetcher is None:
+      # A new prefetcher, with a random configuration.
+      samples = StressSamples(prng.randint(1, args.max_dataset_size + 1),
+                              args.slow_prob)
+      final_batch = prng.uniform() < 0.5
+      ordered = prng.uniform() < 0.5
+      prefetcher = Prefetcher(
+        samples, samples.dataset_size,
+        prng.randint(1, args.max_batch_size + 1),
+        final_batch=final_batch,
+        num_threads=prng.randint(1, args.max_workers + 1),
+        prefetch_size=prng.randint(1, 2 * args.max_batch_size + 1),
+        backend=backend,
+        ordered=ordered,
+        overlap_epochs=prng.uniform() < 0.5)
+
+    # Consume a few whole epochs, then maybe part of one.
+    for _ in range(prng.randint(0, 3)):
+      epoch_samples = []
+      done = False
+      while not done:
+        batch, done = prefetcher.next_batch()
+        epoch_samples.extend(batch)
+      check_epoch(epoch_samples, prefetcher.ep, prefetcher.dataset_size,
+                  prefetcher.full_dataset_size, ordered)
+      num_epochs += 1
+    for _ in range(prng.randint(0, 3)):
+      batch, done = prefetcher.next_batch()
+      if done:
+        break
+
+    # Reconfigure.
+    action = prng.choice(['set_batch_size', 'set_dataset_size', 'stop'],
+                         p=[0.45, 0.45, 0.1])
+    st = time.time()
+    if action == 'set_batch_size':
+      prefetcher.set_batch_size(prng.randint(1, args.max_batch_size + 1))
+    elif action == 'set_dataset_size':
+      samples.dataset_size = prng.randint(1, args.max_dataset_size + 1)
+      prefetcher.set_dataset_size(samples.dataset_size)
+    else:
+      prefetcher.stop()
+      prefetcher = None
+    timings[action].append(time.time() - st)
+
+    if (i + 1) % 100 == 0:
+      print('{}: {} / {} reconfigurations, {} epochs checked'
+            .format(backend, i + 1, args.num_reconfigs, num_epochs))
+  if prefetcher is not None:
+    st = time.time()
+    prefetcher.stop()
+    timings['stop'].append(time.time() - st)
+  return dict(num_epochs=num_epochs, timings=timings)
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Prefetcher Stress Test")
+  parser.add_argument('--backends', type=eval, default=('thread', 'process'))
+  parser.add_argument('--num_reconfigs', type=int, default=2000)
+  parser.add_argument('--max_dataset_size', type=int, default=50)
+  parser.add_argument('--max_batch_size', type=int, default=8)
+  parser.add_argument('--max_workers', type=int, default=4)
+  parser.add_argument('--slow_prob', type=float, default=0.05)
+  parser.add_argument('--seed', type=int, default=1)
+  args = parser.parse_args()
+
+  results = []
+  for backend in args.backends:
+    st = time.time()
+    result = stress(backend, args, np.random.RandomState(args.seed))
+    results.append((backend, result, time.time() - st))
+
+  print('\n=========> {} reconfigurations per backend, all epochs passed '
+        '<========='.format(args.num_reconfigs))
+  for backend, result, elapsed in results:
+    print('{}: {} epochs checked in {:.1f}s'
+          .format(backend, result['num_epochs'], elapsed))
+    for action, times in sorted(result['timings'].items()):
+      if len(times) == 0:
+        continue
+      print('  {:<18} {:>6} calls, mean {:>8.2f} ms, max {:>8.2f} ms'.format(
+        action, len(times), 1000. * np.mean(times), 1000. * np.max(times)))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,79 @@
+"""Compare the batch pre-processing of `PreProcessIm.pre_process_ims` with
+calling `pre_process_im` on each image, then stacking and casting to float32,
+as batches used to be assembled. Both paths draw the same crops and mirrors
+from the same seed, which is checked along with the output values.
+
+Example:
+  python script/experiment/preprocess_benchmark.py \
+    --input_h_ws "((256, 128), (128, 64))"
+"""
+from __future__ import print_function
+
+import sys
+sys.path.insert(0, '.')
+
+import time
+import argparse
+import numpy as np
+
+from plus_vcfl.dataset.PreProcessImage import PreProcessIm
+
+
+def best_time(func, num_runs):
+  """The result of `func` and its best time of `num_runs` runs, in ms."""
+  times = []
+  for _ in range(num_runs):
+    st = time.time()
+    ret = func()
+    times.append(time.time() - st)
+  return ret, 1000. * min(times)
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Pre-processing Benchmark")
+  parser.add_argument('--num_ims', type=int, default=128)
+  parser.add_argument('--input_h_ws', type=eval,
+                      default=((256, 128), (128, 64)))
+  parser.add_argument('--resize_h_w', type=eval, default=(256, 128))
+  parser.add_argument('--crop_prob', type=float, default=0.5)
+  parser.add_argument('--crop_ratio', type=float, default=0.9)
+  parser.add_argument('--num_runs', type=int, default=5)
+  parser.add_argument('--seed', type=int, default=1)
+  args = parser.parse_args()
+
+  pre_process_im = PreProcessIm(
+    crop_prob=args.crop_prob,
+    crop_ratio=args.crop_ratio,
+    resize_h_w=args.resize_h_w,
+    scale=True,
+    im_mean=[0.486, 0.459, 0.408],
+    im_std=[0.229, 0.224, 0.225],
+    mirror_type='random',
+    batch_dims='NCHW')
+
+  def per_image(ims):
+    prng = np.random.RandomState(args.seed)
+    ims, mirrored = zip(*[pre_process_im(im, prng=prng) for im in ims])
+    return np.stack(ims).astype(np.float32), np.array(mirrored)
+
+  def batch(ims):
+    return pre_process_im.pre_process_ims(
+      ims, prng=np.random.RandomState(args.seed))
+
+  print('{} images, resized to {}, crop_prob {}, random mirror'
+        .format(args.num_ims, args.resize_h_w, args.crop_prob))
+  print('{:<14} {:>16} {:>12} {:>14}'.format(
+    'input size', 'per-image (ms)', 'batch (ms)', 'max abs diff'))
+  for input_h_w in args.input_h_ws:
+    ims = np.random.RandomState(0).randint(
+      0, 256, size=[args.num_ims] + list(input_h_w) + [3]).astype(np.uint8)
+    (ims1, mirrored1), ms1 = best_time(lambda: per_image(ims), args.num_runs)
+    (ims2, mirrored2), ms2 = best_time(lambda: batch(ims), args.num_runs)
+    assert np.array_equal(mirrored1, mirrored2), \
+      'The two paths drew different mirrors'
+    print('{:<14} {:>16.1f} {:>12.1f} {:>14.2e}'.format(
+      '{}x{}'.format(*input_h_w), ms1, ms2, np.abs(ims1 - ims2).max()))
+
+
+if __name__ == '__main__':
+  main()
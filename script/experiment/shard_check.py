@@ -0,0 +1,127 @@
+"""Check sharded training sets against a single process: run `num_shards`
+CPU processes, each iterating shard `shard_index` of the trainval set for a
+few epochs, and check that the shards of an epoch are disjoint, have the
+same number of batches of `ids_per_batch` ids x `ims_per_id` images, and
+hold exactly the samples (ids, image names, crops and mirrors, compared by
+hashing the pixels) that one unsharded process, with the same seed, yields
+at the same positions of the epoch. Run it from the repo root.
+
+Example:
+  python script/experiment/shard_check.py --num_shards 4
+"""
+from __future__ import print_function
+
+import sys
+sys.path.insert(0, '.')
+
+import argparse
+import hashlib
+import multiprocessing
+
+from plus_vcfl.dataset import create_dataset
+
+
+def iterate(args, num_shards, shard_index, final_batch=False):
+  """Returns a list, per epoch, of a list, per batch, of (label, image name,
+  md5 of the image, mirrored) of its images."""
+  train_set = create_dataset(
+    name=args.dataset,
+    part='trainval',
+    ids_per_batch=args.ids_per_batch,
+    ims_per_id=args.ims_per_id,
+    final_batch=final_batch,
+    resize_h_w=args.resize_h_w,
+    scale=True,
+    im_mean=[0.486, 0.459, 0.408],
+    im_std=[0.229, 0.224, 0.225],
+    mirror_type='random',
+    batch_dims='NCHW',
+    crop_prob=0.5,
+    crop_ratio=0.9,
+    num_prefetch_threads=args.num_prefetch_threads,
+    prefetch_backend=args.prefetch_backend,
+    overlap_epochs=True,
+    seed=args.seed,
+    num_shards=num_shards,
+    shard_index=shard_index)
+  epochs = []
+  for _ in range(args.num_epochs):
+    batches = []
+    done = False
+    while not done:
+      ims, im_names, labels, _, mirrored, done = train_set.next_batch()
+      batches.append([
+        (l, n, hashlib.md5(im.tobytes()).hexdigest(), m)
+        for l, n, im, m in zip(labels, im_names, ims, mirrored)])
+    epochs.append(batches)
+  train_set.stop_prefetching_threads()
+  return epochs
+
+
+def run_shard(args, shard_index, results):
+  results.put((shard_index, iterate(args, args.num_shards, shard_index)))
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Sharded TrainSet Check")
+  parser.add_argument('-d', '--dataset', type=str, default='market1501',
+                      choices=['market1501', 'cuhk03', 'duke', 'combined'])
+  parser.add_argument('--num_shards', type=int, default=3)
+  parser.add_argument('--num_epochs', type=int, default=3)
+  parser.add_argument('--ids_per_batch', type=int, default=4)
+  parser.add_argument('--ims_per_id', type=int, default=4)
+  parser.add_argument('--resize_h_w', type=eval, default=(256, 128))
+  parser.add_argument('--num_prefetch_threads', type=int, default=2)
+  parser.add_argument('--prefetch_backend', type=str, default='thread',
+                      choices=['thread', 'process'])
+  parser.add_argument('--seed', type=int, default=1)
+  args = parser.parse_args()
+  assert args.num_shards > 1
+
+  # One non-daemon process per shard, so that each can fork prefetching
+  # processes of its own.
+  results = multiprocessing.Queue()
+  processes = [
+    multiprocessing.Process(target=run_shard, args=(args, k, results))
+    for k in range(args.num_shards)]
+  for p in processes:
+    p.start()
+  shards = dict(results.get() for _ in processes)
+  for p in processes:
+    p.join()
+  # Keeps the final batch, so that it holds every position of the epoch.
+  single = iterate(args, 1, 0, final_batch=True)
+
+  for ep in range(args.num_epochs):
+    num_batches = set(len(shards[k][ep]) for k in range(args.num_shards))
+    assert len(num_batches) == 1, \
+      'Epoch {}: shards have {} batches'.format(ep + 1, sorted(num_batches))
+    for k in range(args.num_shards):
+      for batch in shards[k][ep]:
+        assert len(batch) == args.ids_per_batch * args.ims_per_id
+        assert len(set(s[0] for s in batch)) == args.ids_per_batch
+    # Shard k starts at position k * shard_size of the unsharded epoch, and
+    # holds the positions after it in order. A position is an id, i.e.
+    # `ims_per_id` images.
+    unsharded = [s for batch in single[ep] for s in batch]
+    shard_ims = len(unsharded) // args.num_shards // args.ims_per_id \
+      * args.ims_per_id
+    for k in range(args.num_shards):
+      sharded = [s for batch in shards[k][ep] for s in batch]
+      start = k * shard_ims
+      assert sharded == unsharded[start:start + len(sharded)], \
+        'Epoch {}: shard {} differs from the unsharded epoch'.format(
+          ep + 1, k)
+    labels = [set(s[0] for batch in shards[k][ep] for s in batch)
+              for k in range(args.num_shards)]
+    assert sum(len(l) for l in labels) == len(set.union(*labels)), \
+      'Epoch {}: shards share ids'.format(ep + 1)
+    print('Epoch {}: {} shards x {} batches, {} of {} ids, identical to the '
+          'unsharded epoch'.format(
+            ep + 1, args.num_shards, num_batches.pop(),
+            len(set.union(*labels)), len(set(s[0] for s in unsharded))))
+  print('All epochs passed')
+
+
+if __name__ == '__main__':
+  main()
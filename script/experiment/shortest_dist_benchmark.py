@@ -0,0 +1,124 @@
+"""Benchmark `distance.shortest_dist`, which fills the table of the local
+distance's shortest path with one rolling row updated in place, against the
+full table filled cell by cell with `np.stack` + `np.min`, and
+`distance.local_dist` against the same computed with that table and the
+exponential taken twice, kept here as the references. Results are checked
+to be bit-identical. The sizes are those of `TestSet.eval`: one query x
+gallery chunk of the local distance, and `low_memory_matrix_op(local_dist)`
+over a query x gallery set split into chunks of about that size.
+
+Example:
+  python script/experiment/shortest_dist_benchmark.py \
+    --chunk_size 200 --num_query 400 --num_gallery 2000
+"""
+from __future__ import print_function
+
+import sys
+sys.path.insert(0, '.')
+
+import time
+import argparse
+import numpy as np
+
+from plus_vcfl.utils import distance
+
+
+def table_shortest_dist(dist_mat):
+  """The reference: the whole [m, n, ...] table, a new array per cell."""
+  m, n = dist_mat.shape[:2]
+  dist = np.zeros_like(dist_mat)
+  for i in range(m):
+    for j in range(n):
+      if (i == 0) and (j == 0):
+        dist[i, j] = dist_mat[i, j]
+      elif (i == 0) and (j > 0):
+        dist[i, j] = dist[i, j - 1] + dist_mat[i, j]
+      elif (i > 0) and (j == 0):
+        dist[i, j] = dist[i - 1, j] + dist_mat[i, j]
+      else:
+        dist[i, j] = \
+          np.min(np.stack([dist[i - 1, j], dist[i, j - 1]], axis=0), axis=0) \
+          + dist_mat[i, j]
+  return dist[-1, -1].copy()
+
+
+def reference_local_dist(x, y):
+  """The reference of `distance.local_dist` for [M, m, d] and [N, n, d]
+  inputs."""
+  M, m, d = x.shape
+  N, n, d = y.shape
+  dist_mat = distance.compute_dist(
+    x.reshape([M * m, d]), y.reshape([N * n, d]))
+  dist_mat = (np.exp(dist_mat) - 1.) / (np.exp(dist_mat) + 1.)
+  dist_mat = dist_mat.reshape([M, m, N, n]).transpose([1, 3, 0, 2])
+  return table_shortest_dist(dist_mat)
+
+
+def best_time(func, num_runs):
+  """The result of `func` and its best time of `num_runs` runs, in s."""
+  times = []
+  for _ in range(num_runs):
+    st = time.time()
+    ret = func()
+    times.append(time.time() - st)
+  return ret, min(times)
+
+
+def local_feats(num, args, prng):
+  return prng.randn(num, args.num_stripes, args.dim).astype(args.dtype)
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Shortest Path Benchmark")
+  parser.add_argument('--num_stripes', type=int, default=8)
+  parser.add_argument('--dim', type=int, default=128)
+  parser.add_argument('--dtype', type=str, default='float32')
+  parser.add_argument('--chunk_size', type=int, default=200)
+  parser.add_argument('--num_query', type=int, default=400)
+  parser.add_argument('--num_gallery', type=int, default=2000)
+  parser.add_argument('--num_runs', type=int, default=3)
+  parser.add_argument('--seed', type=int, default=1)
+  args = parser.parse_args()
+  prng = np.random.RandomState(args.seed)
+
+  # One chunk: the squashed [m, m, Q, G] stripe distances of TestSet.eval.
+  q = local_feats(args.chunk_size, args, prng)
+  g = local_feats(args.chunk_size, args, prng)
+  M, m, d = q.shape
+  dist_mat = distance.squash_dist(distance.compute_dist(
+    q.reshape([-1, d]), g.reshape([-1, d])))
+  dist_mat = dist_mat.reshape([M, m, M, m]).transpose([1, 3, 0, 2])
+  ref, ref_time = best_time(
+    lambda: table_shortest_dist(dist_mat), args.num_runs)
+  new, new_time = best_time(
+    lambda: distance.shortest_dist(dist_mat), args.num_runs)
+  assert np.array_equal(ref, new), 'Results are not bit-identical'
+  print('shortest_dist on one {0} x {0} chunk, {1} stripes x {2} dims, {3}'
+        .format(args.chunk_size, m, d, args.dtype))
+  print('  full table: {:.1f} ms, rolling row: {:.1f} ms, bit-identical'
+        .format(1000 * ref_time, 1000 * new_time))
+
+  # The whole query x gallery local distance, chunked as in TestSet.eval.
+  q = local_feats(args.num_query, args, prng)
+  g = local_feats(args.num_gallery, args, prng)
+  num_splits = (max(1, args.num_query // args.chunk_size),
+                max(1, args.num_gallery // args.chunk_size))
+
+  def chunked(func):
+    return lambda: distance.low_memory_matrix_op(
+      func, q, g, 0, 0, num_splits[0], num_splits[1])
+
+  ref, ref_time = best_time(chunked(reference_local_dist), args.num_runs)
+  new, new_time = best_time(chunked(distance.local_dist), args.num_runs)
+  assert np.array_equal(ref, new), 'Results are not bit-identical'
+  num_chunks = num_splits[0] * num_splits[1]
+  print('low_memory_matrix_op(local_dist), {} query x {} gallery in {} chunks'
+        .format(args.num_query, args.num_gallery, num_chunks))
+  print('  reference: {:.2f} s ({:.0f} ms / chunk), local_dist: {:.2f} s '
+        '({:.0f} ms / chunk), bit-identical'.format(
+          ref_time, 1000 * ref_time / num_chunks,
+          new_time, 1000 * new_time / num_chunks))
+
+
+if __name__ == '__main__':
+  main()
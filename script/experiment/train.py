@@ -17,6 +17,8 @@ import numpy as np
 import argparse
 
 from plus_vcfl.dataset import create_dataset
+from plus_vcfl.dataset.FeatCache import FeatCache
+from plus_vcfl.dataset.FeatCache import file_md5
 from plus_vcfl.model.Model import Model
 from plus_vcfl.model.TripletLoss import TripletLoss
 from plus_vcfl.model.loss import global_loss
@@ -49,6 +51,19 @@ class Config(object):
                         choices=['market1501', 'cuhk03', 'duke', 'combined'])
     parser.add_argument('--trainset_part', type=str, default='trainval',
                         choices=['trainval', 'train'])
+    parser.add_argument('--prefetch_backend', type=str, default='thread',
+                        choices=['thread', 'process'])
+    parser.add_argument('--prefetch_threads', type=int, default=2)
+    parser.add_argument('--use_im_store', type=str2bool, default=False)
+    parser.add_argument('--draft_decode', type=str2bool, default=False)
+    parser.add_argument('--test_feat_on_disk', type=str2bool, default=False)
+    parser.add_argument('--feat_cache_dir', type=str, default='')
+    parser.add_argument('--num_dist_workers', type=int, default=1)
+    parser.add_argument('--dist_memory_mb', type=int, default=None)
+    parser.add_argument('--retrieval_top_k', type=int, default=None)
+    parser.add_argument('--ivf_num_lists', type=int, default=None)
+    parser.add_argument('--ivf_nprobe', type=int, default=8)
+    parser.add_argument('--normalize_in_model', type=str2bool, default=False)
 
     # Only for training set.
     parser.add_argument('--resize_h_w', type=eval, default=(256, 128))
@@ -56,6 +71,9 @@ class Config(object):
     parser.add_argument('--crop_ratio', type=float, default=1)
     parser.add_argument('--ids_per_batch', type=int, default=32)
     parser.add_argument('--ims_per_id', type=int, default=4)
+    parser.add_argument('--cam_aware_sampling', type=str2bool, default=False)
+    parser.add_argument('--im_cache_mb', type=int, default=0)
+    parser.add_argument('--prefetch_stats', type=str2bool, default=False)
 
     parser.add_argument('--log_to_file', type=str2bool, default=True)
     parser.add_argument('--normalize_feature', type=str2bool, default=True)
@@ -100,12 +118,15 @@ class Config(object):
     # Dataset #
     ###########
 
-    # If you want to exactly reproduce the result in training, you have to set
-    # num of threads to 1.
-    if self.seed is not None:
-      self.prefetch_threads = 1
-    else:
-      self.prefetch_threads = 2
+    # With a seed, samples draw random numbers from per-sample streams and are
+    # batched in order, so results do not depend on the num of threads.
+    self.prefetch_threads = args.prefetch_threads
+    # Threads or processes.
+    self.prefetch_backend = args.prefetch_backend
+    # Read images from the file packed by script/dataset/pack_images.py
+    self.use_im_store = args.use_im_store
+    # Decode large JPEG files at a reduced resolution before resizing.
+    self.draft_decode = args.draft_decode
 
     self.dataset = args.dataset
     self.trainset_part = args.trainset_part
@@ -121,9 +142,18 @@ class Config(object):
     self.scale_im = True
     self.im_mean = [0.486, 0.459, 0.408]
     self.im_std = [0.229, 0.224, 0.225]
+    # If True, datasets emit uint8 images, and the model scales and normalizes
+    # them on its device with `im_mean` and `im_std`.
+    self.normalize_in_model = args.normalize_in_model
 
     self.ids_per_batch = args.ids_per_batch
     self.ims_per_id = args.ims_per_id
+    # Whether to draw the images of an id from as many cameras as possible.
+    self.cam_aware_sampling = args.cam_aware_sampling
+    # Budget of the decoded training image cache, 0 to disable.
+    self.im_cache_mb = args.im_cache_mb
+    # Whether to time the training data pipeline and log it every epoch.
+    self.prefetch_stats = args.prefetch_stats
     self.train_final_batch = False
     self.train_mirror_type = ['random', 'always', None][0]
     self.train_shuffle = True
@@ -132,15 +162,34 @@ class Config(object):
     self.test_final_batch = True
     self.test_mirror_type = ['random', 'always', None][2]
     self.test_shuffle = False
+    # Threads computing local distance in test, one per core is a good choice.
+    self.num_dist_workers = args.num_dist_workers
+    # Memory budget of test distance matrices, `None` for most of the
+    # available memory.
+    self.dist_memory_mb = args.dist_memory_mb
+    # Score only the top k gallery samples of each query, without the
+    # query-gallery distance matrix, `None` to score whole matrices. mAP is
+    # defined as for whole matrices, and lower if the top k miss matches.
+    self.retrieval_top_k = args.retrieval_top_k
+    # With `retrieval_top_k`, search an IVF index of this many lists instead
+    # of the whole gallery, `None` for exact search.
+    self.ivf_num_lists = args.ivf_num_lists
+    self.ivf_nprobe = args.ivf_nprobe
 
     dataset_kwargs = dict(
       name=self.dataset,
+      use_im_store=self.use_im_store,
+      draft_decode=self.draft_decode,
       resize_h_w=self.resize_h_w,
-      scale=self.scale_im,
-      im_mean=self.im_mean,
-      im_std=self.im_std,
+      scale=self.scale_im and not self.normalize_in_model,
+      im_mean=None if self.normalize_in_model else self.im_mean,
+      im_std=None if self.normalize_in_model else self.im_std,
       batch_dims='NCHW',
-      num_prefetch_threads=self.prefetch_threads)
+      num_prefetch_threads=self.prefetch_threads,
+      prefetch_backend=self.prefetch_backend,
+      # Batches are consumed within one step, so the buffer can be reused.
+      preallocate_batch=True,
+      seed=self.seed)
 
     prng = np.random
     if self.seed is not None:
@@ -149,11 +198,15 @@ class Config(object):
       part=self.trainset_part,
       ids_per_batch=self.ids_per_batch,
       ims_per_id=self.ims_per_id,
+      cam_aware=self.cam_aware_sampling,
       final_batch=self.train_final_batch,
       shuffle=self.train_shuffle,
       crop_prob=self.crop_prob,
       crop_ratio=self.crop_ratio,
       mirror_type=self.train_mirror_type,
+      im_cache_bytes=self.im_cache_mb * 1024 ** 2,
+      overlap_epochs=True,
+      collect_prefetch_stats=self.prefetch_stats,
       prng=prng)
     self.train_set_kwargs.update(dataset_kwargs)
 
@@ -166,6 +219,11 @@ class Config(object):
       final_batch=self.test_final_batch,
       shuffle=self.test_shuffle,
       mirror_type=self.test_mirror_type,
+      num_dist_workers=self.num_dist_workers,
+      dist_memory_mb=self.dist_memory_mb,
+      retrieval_top_k=self.retrieval_top_k,
+      ivf_num_lists=self.ivf_num_lists,
+      ivf_nprobe=self.ivf_nprobe,
       prng=prng)
     self.test_set_kwargs.update(dataset_kwargs)
 
@@ -257,6 +315,14 @@ class Config(object):
 
     # Saving model weights and optimizer states, for resuming.
     self.ckpt_file = osp.join(self.exp_dir, 'ckpt.pth')
+    # If set, test features are memory mapped to files under this directory
+    # instead of kept in RAM.
+    self.test_feat_dir = None
+    if args.test_feat_on_disk:
+      self.test_feat_dir = osp.join(self.exp_dir, 'test_feat')
+    # If set, test features of model weights loaded from file are cached
+    # here, keyed by the content of the file.
+    self.feat_cache_dir = args.feat_cache_dir
     # Just for loading a pretrained model; no optimizer states is needed.
     self.model_weight_file = args.model_weight_file
 
@@ -277,7 +343,8 @@ class ExtractFeature(object):
     # Force all BN layers to use global mean and variance, also disable
     # dropout.
     self.model.eval()
-    ims = Variable(self.TVT(torch.from_numpy(ims).float()))
+    # Transfer before casting, in case of uint8 images.
+    ims = Variable(self.TVT(torch.from_numpy(ims)).float())
     global_feat, local_feat = self.model(ims)[:2]
     global_feat = global_feat.data.cpu().numpy()
     local_feat = local_feat.data.cpu().numpy()
@@ -330,7 +397,9 @@ def main():
   ###########
 
   model = Model(local_conv_out_channels=cfg.local_conv_out_channels,
-                num_classes=len(train_set.ids2labels))
+                num_classes=len(train_set.ids2labels),
+                im_mean=cfg.im_mean if cfg.normalize_in_model else None,
+                im_std=cfg.im_std if cfg.normalize_in_model else None)
   # Model wrapper
   model_w = DataParallel(model)
 
@@ -377,12 +446,24 @@ def main():
     use_local_distance = (cfg.l_loss_weight > 0) \
                          and cfg.local_dist_own_hard_sample
 
+    # Only weights loaded from a file can be identified by its content.
+    feat_cache, model_key = None, None
+    if load_model_weight and cfg.feat_cache_dir != '':
+      feat_cache = FeatCache(cfg.feat_cache_dir)
+      model_key = file_md5(cfg.model_weight_file
+                           if cfg.model_weight_file != '' else cfg.ckpt_file)
+
     for test_set, name in zip(test_sets, test_set_names):
-      test_set.set_feat_func(ExtractFeature(model_w, TVT))
+      test_set.set_feat_func(ExtractFeature(model_w, TVT),
+                             feat_names=('global_feat', 'local_feat'))
       print('\n=========> Test on dataset: {} <=========\n'.format(name))
       test_set.eval(
         normalize_feat=cfg.normalize_feature,
-        use_local_distance=use_local_distance)
+        use_local_distance=use_local_distance,
+        feat_dir=None if cfg.test_feat_dir is None
+        else osp.join(cfg.test_feat_dir, name),
+        feat_cache=feat_cache,
+        model_key=model_key)
 
   if cfg.only_test:
     test(load_model_weight=True)
@@ -439,7 +520,7 @@ def main():
 
       ims, im_names, labels, cam_labels, mirrored, epoch_done = train_set.next_batch()
 
-      ims_var = Variable(TVT(torch.from_numpy(ims).float()))
+      ims_var = Variable(TVT(torch.from_numpy(ims)).float())
       labels_t = TVT(torch.from_numpy(labels).long())
       labels_var = Variable(labels_t)
 
@@ -583,6 +664,16 @@ def main():
           total_loss_log
     print(log)
 
+    if cfg.prefetch_stats:
+      pf_stats = train_set.prefetcher.stats()
+      train_set.prefetcher.reset_stats()
+      print('Data: {:.2f}ms/sample, waited for data {:.2f}s ({:.1%}), '
+            'workers waited {:.2f}s, queue depth {:.1f} (max {:.0f})'.format(
+        pf_stats['sample_time'] * 1000,
+        pf_stats['consumer_wait_time'], pf_stats['consumer_wait_ratio'],
+        pf_stats['worker_wait_time'],
+        pf_stats['queue_depth_mean'], pf_stats['queue_depth_max'], ))
+
     # Log to TensorBoard
 
     if cfg.log_to_file:
@@ -615,6 +706,19 @@ def main():
         dict(local_dist_ap=l_dist_ap_meter.avg,
              local_dist_an=l_dist_an_meter.avg, ),
         ep)
+      if cfg.prefetch_stats:
+        writer.add_scalars(
+          'data_time',
+          dict(sample_time=pf_stats['sample_time'],
+               consumer_wait_time=pf_stats['consumer_wait_time'],
+               worker_wait_time=pf_stats['worker_wait_time'], ),
+          ep)
+        writer.add_scalars(
+          'data_queue',
+          dict(queue_depth_mean=pf_stats['queue_depth_mean'],
+               queue_depth_max=pf_stats['queue_depth_max'],
+               consumer_wait_ratio=pf_stats['consumer_wait_ratio'], ),
+          ep)
 
     # save ckpt
     if cfg.log_to_file: